@@ -1,4 +1,4 @@
-from flask import Flask, render_template_string, request, jsonify, send_from_directory, send_file
+from flask import Flask, render_template_string, request, jsonify, send_from_directory, send_file, abort, Response, g
 import os
 import cv2
 import numpy as np
@@ -7,9 +7,25 @@ from werkzeug.utils import secure_filename
 from scipy.signal import savgol_filter
 import subprocess
 import requests
-import urllib.request
 from urllib.parse import unquote
-import ssl
+import io
+import json
+import struct
+import tempfile
+import shutil
+import hashlib
+import uuid
+import time
+import threading
+import bisect
+import functools
+import contextlib
+import abc
+import cProfile
+import pstats
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 index_template = """
 <!DOCTYPE html>
@@ -305,6 +321,7 @@ index_template = """
         <button id="pauseBtn" disabled>⏸ Pause</button>
         <button id="playBtn" disabled>▶ Play Processed Video</button>
         <button id="forwardBtn" disabled>⏭ Forward</button>
+        <button id="fullResBtn">🔍 Full Resolution</button>
         <button id="downloadBtn">⬇ Download Video</button>
     </div>
     <div id="metrics"></div>
@@ -314,18 +331,23 @@ index_template = """
 <div id="message"></div>
 
 <script>
+// Every request is scoped to this page's analysis job
+const jobId = "{{JOB_ID}}";
+function jobUrl(path) {
+  return path + (path.includes('?') ? '&' : '?') + 'job_id=' + encodeURIComponent(jobId);
+}
 const videoInput = document.getElementById('videoFile');
 const uploadBtn = document.getElementById('uploadBtn');
 const videoUrlInput = document.getElementById('videoUrl');
 const urlUploadBtn = document.getElementById('urlUploadBtn');
 const videoPlayer = document.getElementById('videoPlayer');
 videoPlayer.onloadeddata = function () {
-    fetch("/extract_assets", {
+    fetch(jobUrl("/extract_assets"), {
         method: 'POST'
     }).then(res => res.json())
       .then(data => {
         if (data.success) {
-            messageDiv.textContent = "✅ Frames and audio extracted!";
+            messageDiv.textContent = "✅ Video indexed, frames load on demand!";
             setStartFrameBtn.disabled = false;
             setEndFrameBtn.disabled = false;
             videoSection.style.display = 'flex';
@@ -351,6 +373,7 @@ const pauseBtn = document.getElementById('pauseBtn');
 const playBtn = document.getElementById('playBtn');
 const forwardBtn = document.getElementById('forwardBtn');
 const downloadBtn = document.getElementById('downloadBtn');
+const fullResBtn = document.getElementById('fullResBtn');
 const metricsDiv = document.getElementById('metrics');
 const frameSlider = document.getElementById('frameSlider');
 
@@ -380,7 +403,7 @@ uploadBtn.addEventListener('click', () => {
   const formData = new FormData();
   formData.append('video', videoInput.files[0]);
 
-  fetch('/upload', {
+  fetch(jobUrl('/upload'), {
     method: 'POST',
     body: formData,
   })
@@ -431,7 +454,7 @@ urlUploadBtn.addEventListener('click', () => {
   videoUrlInput.disabled = true;
   messageDiv.textContent = "Fetching video from URL... Please wait.";
 
-  fetch('/fetch_video', {
+  fetch(jobUrl('/fetch_video'), {
     method: 'POST',
     headers: {'Content-Type': 'application/json'},
     body: JSON.stringify({url: videoUrl})
@@ -502,7 +525,8 @@ function checkFramesSet(){
 }
 
 function loadFrameForROI(frameNumber){
-  fetch('/get_frame/' + frameNumber).then(res => {
+  // The ROI is drawn on a downscaled proxy, /set_roi maps it back to the source resolution
+  fetch(jobUrl('/get_frame/' + frameNumber + '?proxy=1')).then(res => {
     if(res.ok) return res.blob();
     throw new Error("Failed to load frame");
   }).then(blob => {
@@ -585,13 +609,14 @@ setRoiBtn.addEventListener('click', () => {
     alert('Please draw ROI first.');
     return;
   }
-  fetch('/set_roi', {
+  fetch(jobUrl('/set_roi'), {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify(roi)
+    body: JSON.stringify({...roi, proxy_width: frameCanvas.width, proxy_height: frameCanvas.height})
   }).then(res => res.json()).then(data => {
     if (data.success) {
-      roiCoordsSpan.textContent = 'x=${roi.x.toFixed(0)}, y=${roi.y.toFixed(0)}, w=${roi.width.toFixed(0)}, h=${roi.height.toFixed(0)}';
+      const [x, y, w, h] = data.roi;
+      roiCoordsSpan.textContent = `x=${x}, y=${y}, w=${w}, h=${h}`;
       messageDiv.textContent = 'ROI set successfully. Running analysis...';
       runAnalysis();
     } else {
@@ -617,7 +642,7 @@ function runAnalysis() {
 
   console.log("▶ Sending to analysis: start =", start, ", end =", end);
 
-  fetch('/run_analysis', {
+  fetch(jobUrl('/run_analysis'), {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({
@@ -628,7 +653,7 @@ function runAnalysis() {
   .then(res => res.json())
   .then(data => {
     if (data.success) {
-      messageDiv.textContent = '✅ Analysis complete. Playing processed video.';
+      // Analysis runs in the background, processed frames show up as they're written
       roiSection.style.display = 'none';
       processedSection.style.display = 'flex';
       rewindBtn.disabled = false;
@@ -637,11 +662,11 @@ function runAnalysis() {
       forwardBtn.disabled = false;
       processedStartFrame = 0;
       processedEndFrame = data.processed_frame_count ? data.processed_frame_count - 1 : end;
-      displayMetrics(data.metrics);
       currentProcessedFrame = processedStartFrame;
       displayProcessedFrame(currentProcessedFrame);
       frameSlider.max = processedEndFrame;
       frameSlider.value = currentProcessedFrame;
+      watchProgress(data.progress_url);
     } else {
       messageDiv.textContent = '❌ Analysis failed: ' + data.message;
     }
@@ -651,10 +676,38 @@ function runAnalysis() {
   });
 }
 
+function watchProgress(progressUrl) {
+  const source = new EventSource(progressUrl + (progressUrl.includes('?') ? '&' : '?') + 'stream=1');
+  source.onmessage = (event) => {
+    const progress = JSON.parse(event.data);
+    if (progress.stage === 'done') {
+      source.close();
+      const result = progress.result;
+      messageDiv.textContent = `✅ Analysis complete (${result.mode}, ${result.analysis_fps.toFixed(1)} fps). Playing processed video.`;
+      displayMetrics(result.metrics);
+      displayProcessedFrame(currentProcessedFrame);
+    } else if (progress.stage === 'failed') {
+      source.close();
+      messageDiv.textContent = '❌ Analysis failed: ' + progress.error;
+    } else {
+      const eta = progress.eta_seconds !== null ? `, ~${Math.ceil(progress.eta_seconds)}s left` : '';
+      messageDiv.textContent = `⏳ ${progress.stage}: ${progress.frames_done}/${progress.frames_total} frames${eta}`;
+      if (progress.metrics) {
+        displayMetrics(progress.metrics);
+      }
+    }
+  };
+  source.onerror = () => {
+    source.close();
+    messageDiv.textContent = '❌ Lost connection to analysis progress.';
+  };
+}
 
 
-function displayProcessedFrame(frameNum){
-  processedFrame.src = '/processed_frame/' + frameNum;
+
+function displayProcessedFrame(frameNum, fullRes){
+  // Playback and scrubbing use proxies, full resolution only on request
+  processedFrame.src = jobUrl('/processed_frame/' + frameNum + (fullRes ? '' : '?proxy=1'));
   frameSlider.value = frameNum;  // Sync slider position
 }
 
@@ -684,8 +737,13 @@ forwardBtn.addEventListener('click', () => {
   }
 });
 
+fullResBtn.addEventListener('click', () => {
+  pauseProcessedPlayback();
+  displayProcessedFrame(currentProcessedFrame, true);
+});
+
 downloadBtn.addEventListener('click', () => {
-  window.location.href = '/download';
+  window.location.href = jobUrl('/download');
 });
 
 // Slider event for frame navigation
@@ -930,68 +988,998 @@ app.config['PROCESSED_FOLDER'] = 'processed'
 app.config['PROCESSED_VIDEO'] = 'output.mp4'
 app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024  # Limit upload size to 200MB
 app.config['AUDIO_FOLDER'] = 'static_audio'
+# Extracted frames, audio and metadata kept per video content hash, least recently used evicted first
+app.config['INGEST_CACHE_FOLDER'] = 'ingest_cache'
+app.config['INGEST_CACHE_BYTES'] = 5 * 1024 * 1024 * 1024
+# 'memmap' stores decoded frames in one raw array file read through np.memmap, 'png' writes a PNG per frame
+app.config['FRAME_STORE'] = 'memmap'
+# Video decoding goes through OpenCV or an ffmpeg rawvideo pipe (DECODE_THREADS 0 lets ffmpeg pick)
+app.config['DECODER'] = 'opencv'
+app.config['DECODE_THREADS'] = 0
+# Packet index (pts, keyframes) built at ingest so single frames can be decoded on demand,
+# touched frames are kept in a per-job LRU of FRAME_CACHE_BYTES
+app.config['INDEX_FOLDER'] = 'frame_index'
+app.config['FRAME_CACHE_BYTES'] = 64 * 1024 * 1024
+# Without keyframe positions, on-demand reads decode forward instead of seeking for gaps up to this
+app.config['INDEX_FORWARD_FRAMES'] = 30
+# ?proxy=1 frames are downscaled to PROXY_MAX_WIDTH JPEGs for the ROI canvas and the player,
+# full resolution is only sent when asked for
+app.config['PROXY_MAX_WIDTH'] = 960
+app.config['PROXY_JPEG_QUALITY'] = 80
+app.config['PROXY_CACHE_BYTES'] = 32 * 1024 * 1024
+# 'frames' reads the extracted PNGs, 'stream' decodes straight from the video file
+app.config['ANALYSIS_MODE'] = 'frames'
+# Windowed analysis only renders start_frame..end_frame + WINDOW_MARGIN, the rest is served from the source
+app.config['ANALYSIS_WINDOWED'] = False
+app.config['WINDOW_MARGIN'] = 30
+# Frames are read in batches capped by count and decoded size, then masked in
+# stacks of about DETECT_BATCH_PIXELS ROI pixels so each stack stays in cache
+app.config['DETECT_BATCH_SIZE'] = 32
+app.config['DETECT_BATCH_BYTES'] = 256 * 1024 * 1024
+app.config['DETECT_BATCH_PIXELS'] = 128 * 1024
+# More than one worker runs detection in a process pool before the sequential tracking pass,
+# requests are capped at DETECT_WORKERS_MAX and the CPU count
+app.config['DETECT_WORKERS'] = 1
+app.config['DETECT_WORKERS_MAX'] = 8
+# Detection backend: 'hsv' thresholds red over the search area, 'motion' looks for ball-sized moving
+# blobs, 'combined' only thresholds colour inside moving blobs
+app.config['DETECTOR'] = 'hsv'
+# 'diff' compares each frame with the two before it, 'mog2' keeps an OpenCV MOG2 background model of the ROI
+app.config['MOTION_SUBTRACTOR'] = 'diff'
+app.config['MOTION_THRESHOLD'] = 25
+# Ball blobs are between BALL_MIN_SIZE and BALL_MAX_SIZE px across, scaled up for frames taller than BALL_SIZE_HEIGHT
+app.config['BALL_MIN_SIZE'] = 4
+app.config['BALL_MAX_SIZE'] = 10
+app.config['BALL_SIZE_HEIGHT'] = 1080
+# Coarse-to-fine detection: search areas of PYRAMID_MIN_PIXELS or more are scanned at up to 1/PYRAMID_SCALE
+# first, then only patches around up to PYRAMID_MAX_CANDIDATES red spots are checked at full resolution.
+# The coarse stride is capped by the smallest ball (see pyramid_scale()), below 2 px it isn't used
+app.config['PYRAMID_DETECTION'] = False
+app.config['PYRAMID_SCALE'] = 4
+app.config['PYRAMID_MIN_PIXELS'] = 1024 * 1024
+app.config['PYRAMID_MAX_CANDIDATES'] = 8
+# 'kalman' follows the ball with a constant-acceleration Kalman filter and only searches TRACK_WINDOW px
+# (plus the prediction's uncertainty) around where it should be, back to the whole ROI after
+# TRACK_MAX_MISSES misses in a row; 'roi' searches the whole ROI on every frame
+app.config['TRACKER'] = 'roi'
+app.config['TRACK_WINDOW'] = 32
+app.config['TRACK_MAX_MISSES'] = 5
+# Lazy analysis only tracks, /processed_frame renders on request into a byte-bounded LRU
+app.config['LAZY_RENDER'] = False
+app.config['RENDER_CACHE_BYTES'] = 64 * 1024 * 1024
+# Per-job workspaces, removed once a job has been idle for JOB_TTL seconds
+app.config['JOBS_FOLDER'] = 'jobs'
+app.config['JOB_TTL'] = 6 * 60 * 60
+# Analyses run in the background, at most ANALYSIS_THREADS at a time, and report through /progress
+app.config['ANALYSIS_THREADS'] = 2
+app.config['PROGRESS_INTERVAL'] = 0.5
+# Annotated frames are piped into an ffmpeg H.264 encoder while the analysis runs
+app.config['ENCODER_PRESET'] = 'veryfast'
+app.config['ENCODER_CRF'] = 18
+# Processed MP4s are kept per analysis key (video, ROI, range, detector settings), least recently used evicted first
+app.config['VIDEO_CACHE_FOLDER'] = 'video_cache'
+app.config['VIDEO_CACHE_BYTES'] = 2 * 1024 * 1024 * 1024
+# Media URLs aren't content-addressed, so clients keep a copy but revalidate it against the ETag
+app.config['MEDIA_CACHE_CONTROL'] = 'private, no-cache'
+# Remote videos are fetched as DOWNLOAD_CONNECTIONS concurrent ranges of DOWNLOAD_PART_BYTES,
+# partial downloads are kept in DOWNLOAD_FOLDER so a retry of the same URL resumes
+app.config['DOWNLOAD_FOLDER'] = 'downloads'
+app.config['DOWNLOAD_CONNECTIONS'] = 4
+app.config['DOWNLOAD_PART_BYTES'] = 8 * 1024 * 1024
+app.config['DOWNLOAD_TIMEOUT'] = (10, 60)
+app.config['DOWNLOAD_RETRIES'] = 3
+# /metrics serves stage and request latency histograms with these bucket bounds (seconds) in the Prometheus format
+app.config['METRICS_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Analyses started with profile=true (or all of them) run under cProfile, /profile serves the
+# top PROFILE_LINES functions by cumulative time
+app.config['PROFILE_ANALYSIS'] = False
+app.config['PROFILE_LINES'] = 40
 
 pixels_per_meter = 50
 
-roi_coords = None
-video_path = None
-frame_count = 0
-frame_map = {}
-trajectory = []
-accumulated_trajectory = []
-
-for folder in [app.config['UPLOAD_FOLDER'], app.config['FRAME_FOLDER'], app.config['PROCESSED_FOLDER'], app.config['AUDIO_FOLDER']]:
+for folder in [app.config['UPLOAD_FOLDER'], app.config['FRAME_FOLDER'], app.config['PROCESSED_FOLDER'], app.config['AUDIO_FOLDER'], app.config['INGEST_CACHE_FOLDER'], app.config['JOBS_FOLDER'], app.config['VIDEO_CACHE_FOLDER'], app.config['DOWNLOAD_FOLDER'], app.config['INDEX_FOLDER']]:
     os.makedirs(folder, exist_ok=True)
 
-def extract_frames(video_path):
-    global frame_count
-
-    # Ensure frame folder exists
-    if not os.path.exists(app.config['FRAME_FOLDER']):
-        os.makedirs(app.config['FRAME_FOLDER'])
-
-    # Clear old frames
-    for f in os.listdir(app.config['FRAME_FOLDER']):
-        os.remove(os.path.join(app.config['FRAME_FOLDER'], f))
+METRIC_HELP = {
+    'balltracker_stage_seconds': ('histogram', 'Time spent in each pipeline stage per call'),
+    'balltracker_request_seconds': ('histogram', 'Request latency by endpoint, method and status'),
+    'balltracker_frames_decoded_total': ('counter', 'Video frames decoded, by decoder'),
+    'balltracker_detections_total': ('counter', 'Analysed frames the detector found the ball in'),
+    'balltracker_detection_misses_total': ('counter', 'Analysed frames the detector found no ball in'),
+    'balltracker_bytes_written_total': ('counter', 'Bytes written to disk, by kind'),
+}
 
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise Exception(f"Could not open video: {video_path}")
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Telemetry:
+    # In-process counters and histograms rendered in the Prometheus text format. The app runs
+    # as one process, so there is nothing to aggregate across workers
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.series.get(key)
+            if histogram is None:
+                # Per-bucket counts (not yet cumulative), sum, count
+                histogram = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            bucket = bisect.bisect_left(self.buckets, seconds)
+            if bucket < len(self.buckets):
+                histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def render(self):
+        with self.lock:
+            series = sorted((key, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v)
+                            for key, v in self.series.items())
+        lines = []
+        for name, (kind, text) in METRIC_HELP.items():
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for (series_name, labels), value in series:
+                if series_name != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+telemetry = Telemetry(app.config['METRICS_BUCKETS'])
+
+@contextlib.contextmanager
+def timed(stage):
+    # Works as a with block or a function decorator, failed calls are timed too
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        telemetry.observe('balltracker_stage_seconds', time.perf_counter() - t0, stage=stage)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        # Streamed responses (/progress SSE) are timed up to the first byte
+        telemetry.observe('balltracker_request_seconds', time.perf_counter() - started,
+                          endpoint=request.endpoint or 'unmatched', method=request.method,
+                          status=str(response.status_code))
+    return response
+
+# cProfile can't run two profilers at once, a second profiled analysis runs unprofiled
+profile_lock = threading.Lock()
+
+def finish_profile(job, profiler):
+    profiler.disable()
+    profile_lock.release()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(app.config['PROFILE_LINES'])
+    job.profile = out.getvalue()
+
+class Job:
+    # One analysis session: its own folders plus the tracking state that used to be module globals
+    def __init__(self, job_id, workspace=None):
+        self.id = job_id
+        self.workspace = workspace
+        if workspace is None:
+            # The default job keeps the original top-level folders for clients that don't send a job id
+            folders = [app.config['UPLOAD_FOLDER'], app.config['FRAME_FOLDER'],
+                       app.config['PROCESSED_FOLDER'], app.config['AUDIO_FOLDER']]
+        else:
+            folders = [os.path.join(workspace, name) for name in ('uploads', 'frames', 'processed', 'static_audio')]
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+        self.upload_folder, self.frame_folder, self.processed_folder, self.audio_folder = folders
+        # Frames of an indexed but not yet extracted video are looked for here, which stays empty
+        self.workspace_frames = self.frame_folder
+        # Held while the job's video or analysis is being replaced
+        self.lock = threading.RLock()
+        self.render_cache = ByteLRUCache(app.config['RENDER_CACHE_BYTES'])
+        self.frame_cache = ByteLRUCache(app.config['FRAME_CACHE_BYTES'])
+        self.proxy_cache = ByteLRUCache(app.config['PROXY_CACHE_BYTES'])
+        self.index = None
+        self.frame_reader = None
+        self.last_used = time.time()
+        self.video_path = None
+        self.digest = None
+        self.frame_count = 0
+        self.fps = 0
+        # Full-resolution (width, height), set at ingest so proxy responses never decode for it
+        self.source_size = None
+        # Digest of the video whose audio is in audio_folder, and its transcode while it runs
+        self.audio_digest = None
+        self.audio_thread = None
+        self.future = None
+        self.reset()
+
+    def reset(self):
+        self.roi_coords = None
+        self.frame_map = {}
+        self.trajectory = []
+        self.accumulated_trajectory = []
+        self.trajectory_metrics = None
+        self.analysis_state = None
+        # pstats text from the last profiled analysis
+        self.profile = None
+        self.progress = {'stage': 'idle', 'frames_done': 0, 'frames_total': 0, 'stage_started': time.time()}
+        self.render_cache.clear()
+        self.frame_cache.clear()
+        self.proxy_cache.clear()
+        # A new video brings its own packet index, the old one would send random access to the wrong frames
+        self.index = None
+        if self.frame_reader is not None:
+            self.frame_reader.close()
+            self.frame_reader = None
+
+    def running(self):
+        return self.future is not None and not self.future.done()
+
+    def set_stage(self, stage, frames_total=0, **fields):
+        self.progress = dict(self.progress, stage=stage, frames_done=0, frames_total=frames_total,
+                             stage_started=time.time(), **fields)
+
+    def clear_folders(self, *folders):
+        for folder in folders:
+            for f in os.listdir(folder):
+                os.remove(os.path.join(folder, f))
 
+jobs = {}
+jobs_lock = threading.Lock()
+
+def create_job(job_id=None):
+    prune_jobs()
+    job_id = job_id or uuid.uuid4().hex
+    job = Job(job_id, os.path.join(app.config['JOBS_FOLDER'], job_id))
+    with jobs_lock:
+        # Two first uploads for the same page can race here, both get whichever landed first
+        return jobs.setdefault(job_id, job)
+
+def prune_jobs():
+    cutoff = time.time() - app.config['JOB_TTL']
+    with jobs_lock:
+        stale = [job for job in jobs.values() if job.last_used < cutoff and not job.running()]
+        for job in stale:
+            del jobs[job.id]
+    for job in stale:
+        # The reader holds the video open, and its decoder threads, until it's closed
+        if job.frame_reader is not None:
+            job.frame_reader.close()
+            job.frame_reader = None
+        shutil.rmtree(job.workspace, ignore_errors=True)
+
+def current_job(create=False):
+    # create=True is for the routes that bring a video: the id the page was rendered with
+    # only gets a workspace once it's actually used
+    job_id = (request.args.get('job_id') or request.form.get('job_id')
+              or (request.get_json(silent=True) or {}).get('job_id'))
+    if not job_id:
+        return default_job
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None and create and re.fullmatch(r'[0-9a-f]{32}', job_id):
+        job = create_job(job_id)
+    if job is None:
+        abort(404, description=f'Unknown job: {job_id}')
+    job.last_used = time.time()
+    return job
+
+def job_url(job, path):
+    return path if job is default_job else f"{path}?job_id={job.id}"
+
+# Raw frame store: a fixed-size header followed by (count, height, width, channels) uint8 frames
+FRAME_STORE_FILE = 'frames.raw'
+FRAME_STORE_MAGIC = b'FRMS'
+FRAME_STORE_HEADER = 64
+
+def write_frame_store(frames, path):
     cnt = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret or frame is None:
-            break
-
+    shape = (0, 0, 3)
+    with open(path, 'wb') as f:
+        f.write(bytes(FRAME_STORE_HEADER))
+        for frame in frames:
+            if cnt == 0:
+                shape = frame.shape
+            elif frame.shape != shape:
+                raise Exception(f"Frame {cnt} is {frame.shape}, expected {shape}")
+            f.write(np.ascontiguousarray(frame).data)
+            cnt += 1
+        # The count is only known once decoding ends, so the header goes in last
+        f.seek(0)
+        f.write(struct.pack('<4sIIII', FRAME_STORE_MAGIC, cnt, *shape))
+    return cnt
+
+def open_frame_store(folder):
+    path = os.path.join(folder, FRAME_STORE_FILE)
+    try:
+        with open(path, 'rb') as f:
+            magic, cnt, h, w, c = struct.unpack('<4sIIII', f.read(20))
+    except (OSError, struct.error):
+        return None
+    if magic != FRAME_STORE_MAGIC or cnt == 0:
+        return None
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=FRAME_STORE_HEADER, shape=(cnt, h, w, c))
+
+def count_frames(folder):
+    store = open_frame_store(folder)
+    if store is not None:
+        return len(store)
+    return len([f for f in os.listdir(folder) if f.endswith('.png')])
+
+def write_png_frames(frames, folder):
+    cnt = 0
+    for frame in frames:
         # ✅ No resizing, no cropping — preserve original frame
-        output_path = os.path.join(app.config['FRAME_FOLDER'], f"{cnt}.png")
+        output_path = os.path.join(folder, f"{cnt}.png")
         success = cv2.imwrite(output_path, frame)
         if not success:
             raise Exception(f"Failed to write frame {cnt}")
 
         cnt += 1
+    return cnt
+
+def store_frames(frames, folder, backend=None):
+    backend = backend or app.config['FRAME_STORE']
 
+    # Ensure frame folder exists
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    # Clear old frames
+    for f in os.listdir(folder):
+        os.remove(os.path.join(folder, f))
+
+    if backend == 'memmap':
+        return write_frame_store(frames, os.path.join(folder, FRAME_STORE_FILE))
+    return write_png_frames(frames, folder)
+
+@timed('extract_frames')
+def extract_frames(video_path, folder=None, backend=None, decoder=None):
+    folder = folder or app.config['FRAME_FOLDER']
+    frames = (frame for _, frame in iter_video_frames(video_path, decoder=decoder))
+    count = store_frames(frames, folder, backend)
+    telemetry.inc('balltracker_bytes_written_total', folder_size(folder), kind='frames')
+    return count
+
+def probe_ffmpeg():
+    # Run once at startup instead of spawning ffmpeg -version on every upload
+    caps = {'available': False, 'version': None, 'libx264': False, 'libmp3lame': False}
+    try:
+        version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=10)
+        encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return caps
+    caps['available'] = version.returncode == 0
+    caps['version'] = version.stdout.split('\n', 1)[0]
+    caps['libx264'] = ' libx264 ' in encoders.stdout
+    caps['libmp3lame'] = ' libmp3lame ' in encoders.stdout
+    return caps
+
+# Detection workers never ingest or encode, so only the server process pays for the probe
+if multiprocessing.current_process().name == 'MainProcess':
+    FFMPEG = probe_ffmpeg()
+    print(f"🎛️ {FFMPEG['version'] or 'ffmpeg not found'}")
+else:
+    FFMPEG = {'available': False, 'version': None, 'libx264': False, 'libmp3lame': False}
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_and_hash(stream, path):
+    # Hash while writing so a cache hit doesn't need a second read of the file
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def keyed_lock(locks, guard, key):
+    # One lock per key, dropped from locks once nobody holds or waits on it so
+    # digests and URLs of long-gone jobs don't pile up
+    with guard:
+        entry = locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del locks[key]
+
+_ingest_locks = {}
+_ingest_locks_guard = threading.Lock()
+
+def ingest_lock(digest):
+    return keyed_lock(_ingest_locks, _ingest_locks_guard, digest)
+
+def folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+def evict_ingest_cache(keep):
+    # Entries a live job still reads from are never evicted
+    cache = app.config['INGEST_CACHE_FOLDER']
+    entries = []
+    for digest in os.listdir(cache):
+        meta_path = os.path.join(cache, digest, 'meta.json')
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path) as f:
+            size = json.load(f).get('bytes', 0)
+        entries.append((os.path.getmtime(meta_path), digest, size))
+    total = sum(size for _, _, size in entries)
+    for _, digest, size in sorted(entries):
+        if total <= app.config['INGEST_CACHE_BYTES']:
+            break
+        if digest in keep:
+            continue
+        print(f"🧹 Evicting ingest cache entry {digest[:12]}")
+        shutil.rmtree(os.path.join(cache, digest), ignore_errors=True)
+        index_path = os.path.join(app.config['INDEX_FOLDER'], f"{digest}.json")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        total -= size
+
+def build_frame_index(path):
+    # Packet scan without decoding: framecrc lists every video packet's pts and marks
+    # non-keyframes with F=, sorting by pts gives presentation order, i.e. frame numbers
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-i', path, '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Could not index video: {result.stderr.strip()[-300:]}")
+    time_base = (1, 1)
+    width = height = 0
+    packets = []
+    for line in result.stdout.splitlines():
+        if line.startswith('#tb 0:'):
+            num, den = line.split(':', 1)[1].strip().split('/')
+            time_base = (int(num), int(den))
+        elif line.startswith('#dimensions 0:'):
+            width, height = map(int, line.split(':', 1)[1].strip().split('x'))
+        elif line and not line.startswith('#'):
+            fields = [f.strip() for f in line.split(',')]
+            dts, pts = fields[1], fields[2]
+            pts = int(pts) if pts.lstrip('-').isdigit() else int(dts)
+            packets.append((pts, not any(f.startswith('F=') for f in fields[6:])))
+    packets.sort()
+    pts = [p for p, _ in packets]
+    keyframes = [n for n, (_, key) in enumerate(packets) if key]
+    fps = 0.0
+    if len(pts) > 1 and pts[-1] > pts[0]:
+        fps = (len(pts) - 1) / ((pts[-1] - pts[0]) * time_base[0] / time_base[1])
+    return {'time_base': time_base, 'pts': pts, 'keyframes': keyframes,
+            'frame_count': len(pts), 'fps': fps, 'width': width, 'height': height}
+
+def load_frame_index(path, digest):
+    index_path = os.path.join(app.config['INDEX_FOLDER'], f"{digest}.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            return json.load(f)
+    index = build_frame_index(path)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    return index
+
+def frame_time(index, frame_number):
+    num, den = index['time_base']
+    return (index['pts'][frame_number] - index['pts'][0]) * num / den
+
+def extract_audio_async(video_path, audio_path):
+    def run():
+        extract_audio(video_path, audio_path + '.tmp.mp3')
+        if os.path.exists(audio_path + '.tmp.mp3'):
+            os.replace(audio_path + '.tmp.mp3', audio_path)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def job_audio_path(job):
+    return os.path.join(job.audio_folder, 'extracted_audio.mp3')
+
+def wait_for_audio(job):
+    # A transcode still running would write into the folder after it's been cleared
+    if job.audio_thread is not None:
+        job.audio_thread.join()
+        job.audio_thread = None
+
+def clear_audio(job, digest):
+    wait_for_audio(job)
+    job.clear_folders(job.audio_folder)
+    job.audio_digest = digest
+
+def start_job_audio(job, path, digest):
+    # One transcode per video per job, re-indexing the same video keeps the one done or running
+    if job.audio_digest == digest:
+        return
+    clear_audio(job, digest)
+    if FFMPEG['libmp3lame']:
+        job.audio_thread = extract_audio_async(path, job_audio_path(job))
+
+def index_video(job, path, digest=None):
+    # Cheap ingest: hash and packet index only, frames are decoded on demand until an
+    # analysis needs all of them, so the first ROI frame doesn't wait on the clip length
+    digest = digest or hash_file(path)
+    entry = os.path.join(app.config['INGEST_CACHE_FOLDER'], digest)
+    if os.path.exists(os.path.join(entry, 'meta.json')):
+        # Already extracted for an earlier upload, link the frames straight away
+        return ingest_video(job, path, digest)
+
+    with ingest_lock(digest):
+        index = load_frame_index(path, digest)
+    job.digest = digest
+    job.index = index
+    job.frame_folder = job.workspace_frames
+    job.clear_folders(job.frame_folder)
+    job.frame_count = index['frame_count']
+    fps, _ = probe_video(path)
+    job.fps = fps or index['fps']
+    job.source_size = (index['width'], index['height']) if index.get('width') else probe_frame_size(path)
+    start_job_audio(job, path, digest)
+    return {'digest': digest, 'fps': job.fps, 'frame_count': job.frame_count, 'indexed': True}
+
+def ingest_video(job, path, digest=None):
+    # Frames, audio and metadata are cached per content hash, a repeat ingest only relinks them
+    digest = digest or hash_file(path)
+    entry = os.path.join(app.config['INGEST_CACHE_FOLDER'], digest)
+    meta_path = os.path.join(entry, 'meta.json')
+
+    with ingest_lock(digest):
+        if os.path.exists(meta_path):
+            os.utime(meta_path)
+            with open(meta_path) as f:
+                meta = json.load(f)
+            print(f"♻️ Ingest cache hit for {digest[:12]}")
+        else:
+            staging = entry + '.tmp'
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            # The audio transcode runs in its own ffmpeg process while OpenCV decodes the frames,
+            # so ingest takes as long as the slower of the two rather than their sum. A job that
+            # already transcoded this video's audio hands that over instead
+            reuse = job.audio_digest == digest
+            audio = None
+            if not reuse and FFMPEG['libmp3lame']:
+                audio = start_audio_extraction(path, os.path.join(staging, 'audio.mp3'))
+            try:
+                count = extract_frames(path, os.path.join(staging, 'frames'))
+            finally:
+                if audio is not None:
+                    audio.wait()
+            if reuse:
+                wait_for_audio(job)
+                if os.path.exists(job_audio_path(job)):
+                    shutil.copyfile(job_audio_path(job), os.path.join(staging, 'audio.mp3'))
+            fps, _ = probe_video(path)
+            meta = {'digest': digest, 'fps': fps, 'frame_count': count, 'bytes': folder_size(staging)}
+            with open(os.path.join(staging, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(staging, entry)
+
+    job.digest = digest
+    job.frame_folder = os.path.join(entry, 'frames')
+    job.frame_count = meta['frame_count']
+    job.fps = meta['fps']
+    store = open_frame_store(job.frame_folder)
+    job.source_size = (store.shape[2], store.shape[1]) if store is not None else probe_frame_size(path)
+    job.frame_cache.clear()
+    with jobs_lock:
+        in_use = {j.digest for j in jobs.values()} | {default_job.digest}
+    evict_ingest_cache(keep=in_use)
+    audio = os.path.join(entry, 'audio.mp3')
+    if job.audio_digest != digest:
+        clear_audio(job, digest)
+        if os.path.exists(audio):
+            shutil.copyfile(audio, job_audio_path(job))
+    return meta
+
+def probe_video(path):
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     cap.release()
-    frame_count = cnt
-    return frame_count
+    return fps, total_frames
 
-def generate_processed_video():
-    frame_files = sorted([f for f in os.listdir(app.config['PROCESSED_FOLDER']) if f.endswith('.jpg')],
-                         key=lambda x: int(re.sub(r'\D', '', x)))
-    if not frame_files:
+def probe_frame_size(path):
+    # Container metadata only, nothing is decoded
+    cap = cv2.VideoCapture(path)
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return size if all(size) else None
+
+def seek_capture(cap, frame_number):
+    if frame_number <= 0:
         return
-    sample_frame = cv2.imread(os.path.join(app.config['PROCESSED_FOLDER'], frame_files[0]))
-    height, width = sample_frame.shape[:2]
-    out_path = os.path.join(app.config['PROCESSED_FOLDER'], app.config['PROCESSED_VIDEO'])
-    out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'mp4v'), 30, (width, height))
-    for f in frame_files:
-        img = cv2.imread(os.path.join(app.config['PROCESSED_FOLDER'], f))
-        out.write(img)
-    out.release()
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != frame_number:
+        # Backend can't seek this container accurately, rewind and skip forward instead
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        for _ in range(frame_number):
+            if not cap.grab():
+                break
+
+def iter_opencv_frames(path, start_frame=0, stop_frame=None):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise Exception(f"Could not open video: {path}")
+    frame_number = start_frame
+    try:
+        seek_capture(cap, start_frame)
+        while stop_frame is None or frame_number <= stop_frame:
+            ret, frame = cap.read()
+            if not ret or frame is None:
+                break
+            yield frame_number, frame
+            frame_number += 1
+    finally:
+        cap.release()
+        telemetry.inc('balltracker_frames_decoded_total', frame_number - start_frame, decoder='opencv')
 
-def extract_audio(video_path, output_audio_path):
-    command = [
+def iter_ffmpeg_frames(path, start_frame=0, stop_frame=None):
+    # Threaded ffmpeg decode of only the requested range, read straight into NumPy buffers
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise Exception(f"Could not open video: {path}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    command = ['ffmpeg', '-v', 'error', '-threads', str(app.config['DECODE_THREADS'])]
+    if start_frame > 0:
+        # Half a frame early so timestamp rounding never drops the first requested frame
+        command += ['-ss', f"{(start_frame - 0.5) / fps:.6f}"]
+    command += ['-i', path, '-map', '0:v:0']
+    if stop_frame is not None:
+        command += ['-frames:v', str(stop_frame - start_frame + 1)]
+    command += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-vsync', 'passthrough', 'pipe:1']
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    frame_bytes = width * height * 3
+    frame_number = start_frame
+    try:
+        while True:
+            frame = np.empty((height, width, 3), np.uint8)
+            buf = memoryview(frame).cast('B')
+            got = 0
+            while got < frame_bytes:
+                n = proc.stdout.readinto(buf[got:])
+                if not n:
+                    break
+                got += n
+            if got == 0:
+                break
+            if got != frame_bytes:
+                raise Exception(f"Truncated frame {frame_number} from ffmpeg: {got} of {frame_bytes} bytes")
+            yield frame_number, frame
+            frame_number += 1
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+        telemetry.inc('balltracker_frames_decoded_total', frame_number - start_frame, decoder='ffmpeg')
+
+DECODERS = {'opencv': iter_opencv_frames, 'ffmpeg': iter_ffmpeg_frames}
+
+def iter_video_frames(path, start_frame=0, stop_frame=None, decoder=None):
+    # Every decoder yields (frame_number, BGR frame) for start_frame..stop_frame inclusive
+    return DECODERS[decoder or app.config['DECODER']](path, start_frame, stop_frame)
+
+def iter_stored_frames(folder, start_frame=0, stop_frame=None):
+    store = open_frame_store(folder)
+    if store is None:
+        yield from iter_png_frames(folder, start_frame, stop_frame)
+        return
+    last = len(store) - 1 if stop_frame is None else min(stop_frame, len(store) - 1)
+    for frame_number in range(start_frame, last + 1):
+        # Read-only views into the page cache, callers copy before drawing
+        yield frame_number, store[frame_number]
+
+def iter_png_frames(folder, start_frame=0, stop_frame=None):
+    if stop_frame is None:
+        frame_numbers = sorted(int(re.sub(r'\D', '', f)) for f in os.listdir(folder) if f.endswith(".png"))
+        frame_numbers = [n for n in frame_numbers if n >= start_frame]
+    else:
+        # Known window, no need to list and sort the whole folder
+        frame_numbers = range(start_frame, stop_frame + 1)
+    for frame_number in frame_numbers:
+        img = cv2.imread(os.path.join(folder, f"{frame_number}.png"))
+        if img is None:
+            break
+        yield frame_number, img
+
+class FrameReader:
+    # Decodes single frames on demand from an open capture. A request ahead of the current
+    # position with no keyframe in between decodes forward, anything else seeks, which makes
+    # the decoder restart from the keyframe before the target
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index
+        self.cap = None
+        self.next_frame = 0
+        self.lock = threading.Lock()
+
+    def keyframe_before(self, frame_number):
+        keyframes = self.index['keyframes']
+        return keyframes[max(bisect.bisect_right(keyframes, frame_number) - 1, 0)]
+
+    def should_seek(self, frame_number):
+        if frame_number < self.next_frame:
+            return True
+        if self.index and self.index['keyframes']:
+            return self.keyframe_before(frame_number) > self.next_frame
+        return frame_number - self.next_frame > app.config['INDEX_FORWARD_FRAMES']
+
+    def read(self, frame_number):
+        with self.lock:
+            if self.cap is None:
+                self.cap = cv2.VideoCapture(self.path)
+                if not self.cap.isOpened():
+                    raise Exception(f"Could not open video: {self.path}")
+                self.next_frame = 0
+            if self.should_seek(frame_number):
+                if frame_number == 0:
+                    # seek_capture() leaves frame 0 alone since a fresh capture is already there, this one isn't
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                else:
+                    seek_capture(self.cap, frame_number)
+                self.next_frame = frame_number
+            decoded = frame_number - self.next_frame + 1
+            telemetry.inc('balltracker_frames_decoded_total', decoded, decoder='reader')
+            while self.next_frame < frame_number:
+                if not self.cap.grab():
+                    return None
+                self.next_frame += 1
+            ret, frame = self.cap.read()
+            if not ret:
+                # Past the end leaves the capture somewhere unknown, seek next time
+                self.next_frame = float('inf')
+                return None
+            self.next_frame += 1
+            return frame
+
+    def close(self):
+        with self.lock:
+            if self.cap is not None:
+                self.cap.release()
+                self.cap = None
+
+def read_frame(job, frame_number):
+    store = open_frame_store(job.frame_folder)
+    if store is not None and 0 <= frame_number < len(store):
+        return np.array(store[frame_number])
+    path = os.path.join(job.frame_folder, f"{frame_number}.png")
+    if os.path.exists(path):
+        return cv2.imread(path)
+    if job.video_path and os.path.exists(job.video_path):
+        reader = job.frame_reader
+        if reader is None or reader.path != job.video_path:
+            reader = job.frame_reader = FrameReader(job.video_path, job.index)
+        return reader.read(frame_number)
+    return None
+
+class ByteLRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+default_job = Job('default')
+
+class VideoEncoder:
+    # Raw BGR frames piped into an ffmpeg H.264 process, started on the first frame once the size is known
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps or 30
+        self.proc = None
+        self.writer = None
+        self.log = None
+
+    def start(self, width, height):
+        command = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(self.fps),
+            '-i', '-',
+            '-c:v', 'libx264', '-preset', app.config['ENCODER_PRESET'], '-crf', str(app.config['ENCODER_CRF']),
+            '-pix_fmt', 'yuv420p', '-movflags', '+faststart',
+            self.path
+        ]
+        if not FFMPEG['libx264']:
+            # No ffmpeg with H.264 on PATH, fall back to OpenCV's MPEG-4 writer
+            print("⚠️ ffmpeg/libx264 not found, encoding with OpenCV")
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height))
+            return
+        self.log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log)
+
+    def write(self, frame):
+        if self.proc is None and self.writer is None:
+            height, width = frame.shape[:2]
+            self.start(width, height)
+        if self.writer is not None:
+            self.writer.write(frame)
+        else:
+            self.proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+        if self.proc is not None:
+            self.proc.stdin.close()
+            code = self.proc.wait()
+            self.log.seek(0)
+            error = self.log.read().decode(errors='replace').strip()
+            self.log.close()
+            if code != 0:
+                raise Exception(f"ffmpeg encoder failed ({code}): {error[-500:]}")
+
+    def abort(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.log.close()
+        if self.writer is not None:
+            self.writer.release()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def analysis_video_key(job, roi, detect, first_frame, start_frame, end_frame, stop_frame, tracker='roi',
+                       detector='hsv'):
+    # Everything that changes the rendered video, lazy rendering and worker count don't. roi and
+    # detect (a detection_settings() snapshot) are what the run was started with, not the job's current ones
+    if job.digest is None:
+        job.digest = hash_file(job.video_path)
+    config = detect['config']
+    settings = {'video': job.digest, 'roi': list(roi), 'first_frame': first_frame,
+                'start_frame': start_frame, 'end_frame': end_frame, 'stop_frame': stop_frame,
+                'hsv': detect['hsv'], 'pixels_per_meter': pixels_per_meter, 'fps': job.fps,
+                'preset': app.config['ENCODER_PRESET'], 'crf': app.config['ENCODER_CRF'], 'tracker': tracker}
+    if tracker == 'kalman':
+        settings['track'] = [app.config['TRACK_WINDOW'], app.config['TRACK_MAX_MISSES']]
+    settings['ball_size'] = [config['BALL_MAX_SIZE'], config['BALL_SIZE_HEIGHT'], config['BALL_MIN_SIZE']]
+    if config['PYRAMID_DETECTION']:
+        settings['pyramid'] = [config['PYRAMID_SCALE'], config['PYRAMID_MIN_PIXELS'],
+                               config['PYRAMID_MAX_CANDIDATES']]
+    if detector != 'hsv':
+        settings['detector'] = [detector, app.config['MOTION_SUBTRACTOR'], app.config['MOTION_THRESHOLD']]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:32]
+
+def cached_video_path(key):
+    return os.path.join(app.config['VIDEO_CACHE_FOLDER'], f"{key}.mp4")
+
+def staging_video_path(key, job):
+    # Unique per job so two jobs rendering the same key never share a file
+    return os.path.join(app.config['VIDEO_CACHE_FOLDER'], f"{key}.{job.id}.tmp.mp4")
+
+def processed_video_path(job):
+    if job.analysis_state and job.analysis_state.get('video_key'):
+        return cached_video_path(job.analysis_state['video_key'])
+    return os.path.join(job.processed_folder, app.config['PROCESSED_VIDEO'])
+
+def evict_video_cache():
+    cache = app.config['VIDEO_CACHE_FOLDER']
+    entries = []
+    for f in os.listdir(cache):
+        if f.endswith('.tmp.mp4'):
+            continue
+        path = os.path.join(cache, f)
+        entries.append((os.path.getmtime(path), path, os.path.getsize(path)))
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= app.config['VIDEO_CACHE_BYTES']:
+            break
+        print(f"🧹 Evicting cached video {os.path.basename(path)}")
+        os.remove(path)
+        total -= size
+
+def publish_video(staging, path):
+    telemetry.inc('balltracker_bytes_written_total', os.path.getsize(staging), kind='video')
+    os.replace(staging, path)
+    evict_video_cache()
+
+@timed('export')
+def generate_processed_video(job):
+    # Eager analyses finish the MP4 alongside the JPEGs, only lazy or older runs need a pass here
+    path = processed_video_path(job)
+    if os.path.exists(path):
+        # Touched so the LRU keeps videos that are still being downloaded
+        os.utime(path)
+        return path
+    key = job.analysis_state.get('video_key') if job.analysis_state else None
+    staging = staging_video_path(key, job) if key else path
+    if job.analysis_state and job.analysis_state['lazy']:
+        generate_lazy_processed_video(job, staging)
+    else:
+        frame_files = sorted([f for f in os.listdir(job.processed_folder) if f.endswith('.jpg')],
+                             key=lambda x: int(re.sub(r'\D', '', x)))
+        if not frame_files:
+            return None
+        encoder = VideoEncoder(staging, job.fps)
+        for f in frame_files:
+            encoder.write(cv2.imread(os.path.join(job.processed_folder, f)))
+        encoder.close()
+    if key:
+        publish_video(staging, path)
+    else:
+        telemetry.inc('balltracker_bytes_written_total', os.path.getsize(path), kind='video')
+    return path
+
+def generate_lazy_processed_video(job, out_path):
+    # Lazy analyses have no JPEGs on disk, render the same frames an eager run would have
+    state = job.analysis_state
+    frames = open_frame_source(job, state['mode'], state['start_frame'], state['stop_frame'], state['windowed'])
+    encoder = VideoEncoder(out_path, job.fps)
+    renderer = TrajectoryRenderer()
+    for frame_number, img in frames:
+        if frame_number in job.frame_map:
+            renderer.append(job.frame_map[frame_number])
+        base = annotate_frame(img.copy(), frame_number, renderer, state['start_frame'], state['end_frame'], job.frame_map)
+        encoder.write(base)
+    encoder.close()
+
+def audio_command(video_path, output_audio_path):
+    return [
         'ffmpeg', '-y',
         '-i', video_path,
         '-vn',  # No video
@@ -1001,59 +1989,317 @@ def extract_audio(video_path, output_audio_path):
         '-b:a', '192k',
         output_audio_path
     ]
-    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-def download_video_from_url(url):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        filename = secure_filename(url.split('/')[-1])
-        if not filename or '.' not in filename:
-            filename = 'downloaded_video.mp4'
-        video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        with open(video_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        return video_path, filename
-    else:
-        raise Exception("Failed to download video from URL.")
+
+def count_audio_bytes(output_audio_path):
+    if os.path.exists(output_audio_path):
+        telemetry.inc('balltracker_bytes_written_total', os.path.getsize(output_audio_path), kind='audio')
+
+@timed('extract_audio')
+def extract_audio(video_path, output_audio_path):
+    subprocess.run(audio_command(video_path, output_audio_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    count_audio_bytes(output_audio_path)
+
+def start_audio_extraction(video_path, output_audio_path):
+    # Videos without an audio track just exit non-zero and leave no file, same as extract_audio
+    proc = subprocess.Popen(audio_command(video_path, output_audio_path),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def watch():
+        # Timed here rather than where ingest waits on it, which is after the frames are done
+        with timed('extract_audio'):
+            proc.wait()
+        count_audio_bytes(output_audio_path)
+    threading.Thread(target=watch, daemon=True).start()
+    return proc
+
+_download_session = None
+_download_session_lock = threading.Lock()
+
+def get_download_session():
+    # One pooled session so repeat downloads reuse connections to the bucket
+    global _download_session
+    with _download_session_lock:
+        if _download_session is None:
+            session = requests.Session()
+            pool = app.config['DOWNLOAD_CONNECTIONS'] * 2
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _download_session = session
+        return _download_session
+
+def download_state_path(partial):
+    return partial + '.json'
+
+def load_download_state(partial, url, size, validator):
+    # A partial file is only resumed if it is for the same object
+    try:
+        with open(download_state_path(partial)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (state.get('url'), state.get('size'), state.get('validator')) != (url, size, validator):
+        return None
+    if not os.path.exists(partial) or os.path.getsize(partial) != size:
+        return None
+    return state
+
+def save_download_state(partial, state):
+    tmp = download_state_path(partial) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, download_state_path(partial))
+
+def download_range(session, url, partial, start, end, verify):
+    timeout = app.config['DOWNLOAD_TIMEOUT']
+    for attempt in range(app.config['DOWNLOAD_RETRIES'] + 1):
+        try:
+            with session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True,
+                             timeout=timeout, verify=verify) as response:
+                if response.status_code != 206:
+                    raise Exception(f"Range request returned {response.status_code}")
+                written = 0
+                with open(partial, 'r+b') as f:
+                    f.seek(start)
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        written += len(chunk)
+                if written != end - start + 1:
+                    raise Exception(f"Short read for bytes {start}-{end}: {written}")
+                return written
+        except Exception as e:
+            if attempt == app.config['DOWNLOAD_RETRIES']:
+                raise
+            print(f"🔁 Retrying bytes {start}-{end} after: {e}")
+            time.sleep(0.5 * 2 ** attempt)
+
+def download_stream(session, url, partial, verify):
+    # Servers without ranges or a length get a single sequential GET
+    with session.get(url, stream=True, timeout=app.config['DOWNLOAD_TIMEOUT'], verify=verify) as response:
+        if response.status_code != 200:
+            raise Exception("Failed to download video from URL.")
+        written = 0
+        with open(partial, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+                written += len(chunk)
+    return written
+
+_download_locks = {}
+_download_locks_guard = threading.Lock()
+
+def download_lock(key):
+    return keyed_lock(_download_locks, _download_locks_guard, key)
+
+def download_file(url, path, verify=True, connections=None):
+    # Downloads url to path and returns throughput stats, resuming an earlier partial download
+    session = get_download_session()
+    connections = connections or app.config['DOWNLOAD_CONNECTIONS']
+    part_bytes = app.config['DOWNLOAD_PART_BYTES']
+    key = hashlib.sha256(url.encode()).hexdigest()
+    partial = os.path.join(app.config['DOWNLOAD_FOLDER'], key + '.part')
+
+    # Two jobs fetching the same URL would otherwise write the same partial file
+    with download_lock(key):
+        t0 = time.perf_counter()
+
+        # A one-byte range probe rather than HEAD, presigned bucket URLs are often only valid for GET
+        with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True,
+                         timeout=app.config['DOWNLOAD_TIMEOUT'], verify=verify) as probe:
+            total = probe.headers.get('Content-Range', '').rpartition('/')[2]
+            ranged = probe.status_code == 206 and total.isdigit()
+            size = int(total) if ranged else 0
+            validator = probe.headers.get('ETag') or probe.headers.get('Last-Modified')
+
+        resumed = 0
+        if not ranged:
+            downloaded = download_stream(session, url, partial, verify)
+            parts = 1
+        else:
+            state = load_download_state(partial, url, size, validator)
+            if state is None:
+                state = {'url': url, 'size': size, 'validator': validator, 'part_bytes': part_bytes, 'done': []}
+                # Preallocated so every range can be written straight to its offset
+                with open(partial, 'wb') as f:
+                    f.truncate(size)
+                save_download_state(partial, state)
+            part_bytes = state['part_bytes']
+            ranges = [(start, min(start + part_bytes, size) - 1) for start in range(0, size, part_bytes)]
+            done = set(state['done'])
+            resumed = sum(end - start + 1 for start, end in ranges if start in done)
+            pending = [(start, end) for start, end in ranges if start not in done]
+            parts = len(pending)
+            state_lock = threading.Lock()
+            downloaded = 0
+
+            def fetch(byte_range):
+                written = download_range(session, url, partial, *byte_range, verify)
+                with state_lock:
+                    state['done'].append(byte_range[0])
+                    save_download_state(partial, state)
+                return written
+
+            with ThreadPoolExecutor(max_workers=max(1, min(connections, len(pending)))) as pool:
+                for written in pool.map(fetch, pending):
+                    downloaded += written
+
+        os.replace(partial, path)
+        if os.path.exists(download_state_path(partial)):
+            os.remove(download_state_path(partial))
+        elapsed = time.perf_counter() - t0
+        stats = {'bytes': downloaded + resumed, 'downloaded_bytes': downloaded, 'resumed_bytes': resumed,
+                 'parts': parts, 'connections': max(1, min(connections, parts)) if ranged else 1, 'ranged': ranged,
+                 'seconds': elapsed, 'mbps': downloaded * 8 / elapsed / 1e6 if elapsed > 0 else 0.0}
+        telemetry.inc('balltracker_bytes_written_total', downloaded, kind='download')
+        print(f"⬇️ Downloaded {stats['bytes']} bytes in {elapsed:.2f}s ({stats['mbps']:.1f} Mbit/s, {resumed} resumed)")
+        return stats
+
+@timed('download')
+def download_video_from_url(url, folder=None):
+    filename = secure_filename(url.split('/')[-1])
+    if not filename or '.' not in filename:
+        filename = 'downloaded_video.mp4'
+    video_path = os.path.join(folder or app.config['UPLOAD_FOLDER'], filename)
+    stats = download_file(url, video_path)
+    return video_path, filename, stats
 
 @app.route('/download')
 def download_video():
-    generate_processed_video()
-    return send_file(os.path.join(app.config['PROCESSED_FOLDER'], app.config['PROCESSED_VIDEO']),
-                     as_attachment=True, download_name="Processed_Trajectory.mp4")
+    job = current_job()
+    if job.running():
+        return jsonify({'success': False, 'message': 'Analysis still running'}), 409
+    path = generate_processed_video(job)
+    if path is None:
+        return jsonify({'success': False, 'message': 'No processed frames'}), 404
+    # The analysis key doubles as the ETag, repeat downloads of an unchanged result get a 304
+    key = job.analysis_state.get('video_key') if job.analysis_state else None
+    # ?inline=1 lets a <video> element play and seek the result instead of saving it
+    return send_media(os.path.dirname(path), os.path.basename(path), etag=key,
+                      as_attachment=not request.args.get('inline'), download_name="Processed_Trajectory.mp4")
+
+def send_media(folder, filename, etag=None, **kwargs):
+    # Range requests get a 206 with just that slice, If-None-Match/If-Range are checked against the ETag
+    response = send_from_directory(os.path.abspath(folder), filename, etag=etag or True,
+                                   conditional=True, max_age=None, **kwargs)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = app.config['MEDIA_CACHE_CONTROL']
+    return response
 
 @app.route('/static_audio/<path:filename>')
 def serve_audio(filename):
-    return send_from_directory('static_audio', filename)
+    job = current_job()
+    return send_media(job.audio_folder, filename, etag=f"{job.digest}-audio" if job.digest else None)
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    job = current_job()
+    # The content digest is a strong validator for the job's own video
+    is_source = job.video_path and os.path.basename(job.video_path) == filename
+    return send_media(job.upload_folder, filename, etag=job.digest if is_source else None)
+
+@app.route('/jobs', methods=['POST'])
+def new_job():
+    job = create_job()
+    return jsonify({'success': True, 'job_id': job.id})
 
 
 @app.route('/')
 def index():
-  return render_template_string(index_template.replace("{{VIDEO_URL}}", ""))
+  # Every page load gets its own job id so concurrent users don't share state, the workspace
+  # is only created by the first upload or fetch so reloads and health checks leave nothing behind
+  return render_template_string(index_template.replace("{{VIDEO_URL}}", "").replace("{{JOB_ID}}", uuid.uuid4().hex))
+
+def frame_size(job):
+    # Full-resolution (width, height) of the job's video, probed once for videos that skipped ingest
+    if job.source_size is None and job.video_path:
+        job.source_size = probe_frame_size(job.video_path)
+    return job.source_size
+
+def send_proxy(job, key, load, cache=True):
+    data = job.proxy_cache.get(key)
+    if data is None:
+        frame = load()
+        if frame is None:
+            return '', 404
+        height, width = frame.shape[:2]
+        scale = min(1.0, app.config['PROXY_MAX_WIDTH'] / width)
+        if scale < 1:
+            frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, app.config['PROXY_JPEG_QUALITY']])
+        if not ok:
+            return '', 404
+        data = buf.tobytes()
+        if cache:
+            job.proxy_cache.put(key, data)
+    response = send_file(io.BytesIO(data), mimetype='image/jpeg')
+    size = frame_size(job)
+    if size:
+        # Lets the client map proxy coordinates back to the source frame
+        response.headers['X-Frame-Width'], response.headers['X-Frame-Height'] = map(str, size)
+    return response
+
+def load_processed_frame(job, frame_num):
+    path = os.path.join(job.processed_folder, f"{frame_num}.jpg")
+    if os.path.exists(path):
+        return cv2.imread(path)
+    if job.analysis_state and job.analysis_state['lazy']:
+        img = render_processed_frame(job, frame_num)
+        if img is not None:
+            return img
+    return read_frame(job, frame_num)
 
 @app.route('/get_frame/<int:frame_num>')
 def get_frame(frame_num):
-    path = os.path.join(app.config['FRAME_FOLDER'], f"{frame_num}.png")
+    job = current_job()
+    if request.args.get('proxy'):
+        return send_proxy(job, ('source', frame_num), lambda: read_frame(job, frame_num))
+    path = os.path.join(job.frame_folder, f"{frame_num}.png")
     if os.path.exists(path):
-        return send_from_directory(app.config['FRAME_FOLDER'], f"{frame_num}.png")
-    return '', 404
+        return send_file(os.path.abspath(path), mimetype='image/png')
+    store = open_frame_store(job.frame_folder)
+    if store is not None and 0 <= frame_num < len(store):
+        ok, buf = cv2.imencode('.png', store[frame_num])
+        return send_file(io.BytesIO(buf.tobytes()), mimetype='image/png')
+    # Not extracted yet: decode just this frame from the source and keep it for the next request
+    data = job.frame_cache.get(frame_num)
+    if data is None:
+        frame = read_frame(job, frame_num)
+        if frame is None:
+            return '', 404
+        ok, buf = cv2.imencode('.png', frame)
+        if not ok:
+            return '', 404
+        data = buf.tobytes()
+        job.frame_cache.put(frame_num, data)
+    response = send_file(io.BytesIO(data), mimetype='image/png')
+    if job.index and frame_num < job.index['frame_count']:
+        response.headers['X-Frame-Time'] = f"{frame_time(job.index, frame_num):.6f}"
+    return response
 
 @app.route('/processed_frame/<int:frame_num>')
 def processed_frame(frame_num):
-    path = os.path.join(app.config['PROCESSED_FOLDER'], f"{frame_num}.jpg")
+    job = current_job()
+    if request.args.get('proxy'):
+        # Frames still being rendered would otherwise stay cached as the plain source frame
+        return send_proxy(job, ('processed', frame_num), lambda: load_processed_frame(job, frame_num),
+                          cache=not job.running())
+    path = os.path.join(job.processed_folder, f"{frame_num}.jpg")
     if os.path.exists(path):
-        return send_from_directory(app.config['PROCESSED_FOLDER'], f"{frame_num}.jpg")
-    else:
-        return get_frame(frame_num)
+        return send_from_directory(os.path.abspath(job.processed_folder), f"{frame_num}.jpg")
+    if job.analysis_state and job.analysis_state['lazy']:
+        data = job.render_cache.get(frame_num)
+        if data is None:
+            img = render_processed_frame(job, frame_num)
+            if img is not None:
+                ok, buf = cv2.imencode('.jpg', img)
+                if ok:
+                    data = buf.tobytes()
+                    job.render_cache.put(frame_num, data)
+        if data is not None:
+            return send_file(io.BytesIO(data), mimetype='image/jpeg')
+    return get_frame(frame_num)
     
 from urllib.parse import urlparse, quote, urlunparse
-import urllib.request, ssl
 from werkzeug.utils import secure_filename
 
 @app.route('/play_video')
@@ -1068,33 +2314,26 @@ def play_video():
         encoded_path = quote(parsed.path)
         clean_url = urlunparse((parsed.scheme, parsed.netloc, encoded_path, '', '', ''))
 
+        # ✅ Each bucket link opens in its own job
+        job = create_job()
+
         # ✅ Save filename securely
         filename = secure_filename(os.path.basename(parsed.path))
-        local_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-        # ✅ Optionally skip SSL certs (development only)
-        ssl._create_default_https_context = ssl._create_unverified_context
+        local_path = os.path.join(job.upload_folder, filename)
 
-        # ✅ Download video (quick)
-        urllib.request.urlretrieve(clean_url, local_path)
+        # ✅ Download video in parallel ranges, certs not verified (development only)
+        download_file(clean_url, local_path, verify=False)
 
         # ✅ Set state (but skip extract_frames!)
-        global video_path, roi_coords, frame_map, trajectory, accumulated_trajectory
-        video_path = local_path
-        roi_coords = None
-        frame_map = {}
-        trajectory = []
-        accumulated_trajectory = []
+        job.video_path = local_path
 
         # ✅ Read metadata only
-        cap = cv2.VideoCapture(local_path)
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.release()
+        fps, total_frames = probe_video(local_path)
 
         # ✅ Inject metadata into template
         rendered_html = render_template_string(
-            index_template.replace("{{VIDEO_URL}}", f"/uploads/{filename}")
+            index_template.replace("{{VIDEO_URL}}", job_url(job, f"/uploads/{filename}"))
+                          .replace("{{JOB_ID}}", job.id)
                           .replace("{{FPS}}", str(fps))
                           .replace("{{FRAME_COUNT}}", str(total_frames))
         )
@@ -1107,15 +2346,17 @@ def play_video():
     
 @app.route('/extract_assets', methods=['POST'])
 def extract_assets():
+    job = current_job()
+    # The analysis holds job.lock until it finishes, fail now instead of waiting minutes for it
+    if job.running():
+        return jsonify({'success': False, 'message': 'Analysis already running'}), 409
     try:
-        # Clear folders first
-        for folder in [app.config['FRAME_FOLDER'], app.config['AUDIO_FOLDER'], app.config['PROCESSED_FOLDER']]:
-            for f in os.listdir(folder):
-                os.remove(os.path.join(folder, f))
+        with job.lock:
+            # Audio is left alone, index_video only transcodes it again for a different video
+            job.clear_folders(job.processed_folder)
 
-        # Extract frames + audio
-        extract_frames(video_path)
-        extract_audio(video_path, os.path.join(app.config['AUDIO_FOLDER'], 'extracted_audio.mp3'))
+            # Index the video for on-demand frames, or reuse frames from the ingest cache
+            index_video(job, job.video_path, job.digest)
 
         return jsonify({'success': True})
     except Exception as e:
@@ -1126,322 +2367,1140 @@ def extract_assets():
 
 @app.route('/set_roi', methods=['POST'])
 def set_roi():
-    global roi_coords
+    job = current_job()
+    # The running analysis reads the ROI it was started with, a new one would only show up in its cache key
+    if job.running():
+        return jsonify({'success': False, 'message': 'Analysis already running'}), 409
     data = request.json
     try:
         x = int(data['x'])
         y = int(data['y'])
         w = int(data['width'])
         h = int(data['height'])
-        roi_coords = (x, y, w, h)
-        return jsonify({'success': True, 'message': f'ROI set to {roi_coords}'})
+        if data.get('proxy_width'):
+            # Drawn on a proxy frame: scale back to full resolution and keep it inside the frame
+            size = frame_size(job)
+            if size is None:
+                raise Exception("No video loaded")
+            sx = size[0] / float(data['proxy_width'])
+            sy = size[1] / float(data['proxy_height'])
+            x0 = min(max(round(float(data['x']) * sx), 0), size[0] - 1)
+            y0 = min(max(round(float(data['y']) * sy), 0), size[1] - 1)
+            x1 = min(max(round((float(data['x']) + float(data['width'])) * sx), x0 + 1), size[0])
+            y1 = min(max(round((float(data['y']) + float(data['height'])) * sy), y0 + 1), size[1])
+            x, y, w, h = x0, y0, x1 - x0, y1 - y0
+        job.roi_coords = (x, y, w, h)
+        return jsonify({'success': True, 'message': f'ROI set to {job.roi_coords}', 'roi': job.roi_coords})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 400
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    global video_path, roi_coords, frame_count, frame_map, trajectory, accumulated_trajectory
-    roi_coords = None
-    frame_map = {}
-    trajectory = []
-    accumulated_trajectory = []
-
-    try:
-        # 1. Check for video file in request
-        if 'video' not in request.files:
-            return jsonify({'success': False, 'message': 'No video file uploaded'}), 400
-
-        file = request.files['video']
-        if file.filename == '':
-            return jsonify({'success': False, 'message': 'Filename is empty'}), 400
-
-        # 2. Clean the filename
-        filename = secure_filename(file.filename)
-        if not filename.lower().endswith('.mp4'):
-            return jsonify({'success': False, 'message': 'Only MP4 files are supported'}), 400
+    job = current_job(create=True)
+    if job.running():
+        return jsonify({'success': False, 'message': 'Analysis already running'}), 409
+    # Held for the whole upload so the job's video isn't swapped mid-request
+    with job.lock:
+        try:
+            # 1. Check for video file in request
+            if 'video' not in request.files:
+                return jsonify({'success': False, 'message': 'No video file uploaded'}), 400
 
-        # 3. Create uploads folder if missing
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            file = request.files['video']
+            if file.filename == '':
+                return jsonify({'success': False, 'message': 'Filename is empty'}), 400
 
-        # 4. Save the uploaded file
-        video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(video_path)
+            # 2. Clean the filename
+            filename = secure_filename(file.filename)
+            if not filename.lower().endswith('.mp4'):
+                return jsonify({'success': False, 'message': 'Only MP4 files are supported'}), 400
 
-        # 5. Confirm it saved
-        if not os.path.exists(video_path):
-            return jsonify({'success': False, 'message': f"File not saved at {video_path}"}), 500
+            # 3. Create uploads folder if missing
+            os.makedirs(job.upload_folder, exist_ok=True)
+            job.reset()
+            # A running transcode reads the file this upload may overwrite
+            wait_for_audio(job)
 
-        print(f"📥 Uploaded video saved to: {video_path}")
+            # 4. Save the uploaded file
+            video_path = os.path.join(job.upload_folder, filename)
+            digest = save_and_hash(file.stream, video_path)
+            job.video_path = video_path
 
-        # 6. Check if ffmpeg is installed
-        try:
-            subprocess.run(['ffmpeg', '-version'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except FileNotFoundError:
-            return jsonify({'success': False, 'message': 'ffmpeg not found. Please install FFmpeg and add to system PATH'}), 500
+            # 5. Confirm it saved
+            if not os.path.exists(video_path):
+                return jsonify({'success': False, 'message': f"File not saved at {video_path}"}), 500
 
-        # ✅ 7. Clear all old data
-        for folder in [app.config['FRAME_FOLDER'], app.config['PROCESSED_FOLDER'], app.config['AUDIO_FOLDER']]:
-            for f in os.listdir(folder):
-                os.remove(os.path.join(folder, f))
+            print(f"📥 Uploaded video saved to: {video_path}")
 
-        # ✅ 8. Extract frames and audio
-        extract_frames(video_path)
-        extract_audio(video_path, os.path.join(app.config['AUDIO_FOLDER'], 'extracted_audio.mp3'))
+            # 6. Check if ffmpeg is installed (probed once at startup)
+            if not FFMPEG['available']:
+                return jsonify({'success': False, 'message': 'ffmpeg not found. Please install FFmpeg and add to system PATH'}), 500
 
-        # ✅ 9. Use OpenCV to get FPS and frame count
-        cap = cv2.VideoCapture(video_path)
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.release()
+            # ✅ 7. Clear all old data, the audio goes once the new video's turns out to differ
+            job.clear_folders(job.processed_folder)
 
-        frame_count = total_frames  # update global
+            # ✅ 8. Index the video (or reuse extracted frames), frames are decoded on demand
+            meta = index_video(job, video_path, digest)
 
-        print(f"📸 Extracted {total_frames} frames at {fps:.2f} FPS")
+            # ✅ 9. FPS and frame count come with the cached metadata
+            fps, total_frames = meta['fps'], meta['frame_count']
 
-        # ✅ 10. Return data to frontend
-        return jsonify({
-            'success': True,
-            'frame_count': total_frames,
-            'fps': fps
-        })
+            print(f"📸 Indexed {total_frames} frames at {fps:.2f} FPS")
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'message': f'Upload processing failed: {str(e)}'}), 500
+            # ✅ 10. Return data to frontend
+            return jsonify({
+                'success': True,
+                'job_id': job.id,
+                'frame_count': total_frames,
+                'fps': fps
+            })
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'message': f'Upload processing failed: {str(e)}'}), 500
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return jsonify({'success': False, 'message': f'Upload processing failed: {str(e)}'}), 500
 
     
 @app.route('/fetch_video', methods=['POST'])
 def fetch_video():
-    global video_path, roi_coords, frame_count, frame_map, trajectory, accumulated_trajectory
-    roi_coords = None
-    frame_map = {}
-    trajectory = []
-    accumulated_trajectory = []
-
+    job = current_job(create=True)
+    if job.running():
+        return jsonify({'success': False, 'message': 'Analysis already running'}), 409
     data = request.json
     video_url = data.get('url')
     if not video_url:
         return jsonify({'success': False, 'message': 'Video URL not provided'}), 400
 
     try:
-        video_path_local, filename = download_video_from_url(video_url)
-        video_path = video_path_local
+        with job.lock:
+            job.reset()
+            wait_for_audio(job)
+            video_path_local, filename, download_stats = download_video_from_url(video_url, job.upload_folder)
+            job.video_path = video_path_local
 
-        extract_frames(video_path)
-        extract_audio(video_path, os.path.join(app.config['AUDIO_FOLDER'], 'extracted_audio.mp3'))
+            index_video(job, job.video_path)
 
-        video_url_path = '/uploads/' + filename
-        return jsonify({'success': True, 'frame_count': frame_count, 'video_url': video_url_path})
+        video_url_path = job_url(job, '/uploads/' + filename)
+        return jsonify({'success': True, 'job_id': job.id, 'frame_count': job.frame_count, 'video_url': video_url_path,
+                        'download': download_stats})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error fetching video: {str(e)}'}), 500
 
-def draw_smooth_line(points, img, color, thickness):
-    if len(points) < 5:
-        return img
-    x = points[:, 0]
-    y = points[:, 1]
-    window = min(11, len(x) if len(x) % 2 == 1 else len(x) - 1)
-    if window < 3:
-        return img
-    x_s = savgol_filter(x, window, 2)
-    y_s = savgol_filter(y, window, 2)
-    for i in range(1, len(x_s)):
-        cv2.line(img, (int(x_s[i - 1]), int(y_s[i - 1])), (int(x_s[i]), int(y_s[i])), color, thickness)
-    return img
-
-def run_analysis_internal(start_frame, end_frame):
-    print(f"🧪 Debug: start_frame={start_frame}, end_frame={end_frame}")
-    global roi_coords, frame_map, trajectory, accumulated_trajectory
-
-    for f in os.listdir(app.config['PROCESSED_FOLDER']):
-        os.remove(os.path.join(app.config['PROCESSED_FOLDER'], f))
-
-    x1, y1, w_roi, h_roi = roi_coords
+def smooth_points(points, window):
+    x_s = savgol_filter(points[:, 0], window, 2)
+    y_s = savgol_filter(points[:, 1], window, 2)
+    return np.stack([np.trunc(x_s), np.trunc(y_s)], axis=1).astype(np.int32)
+
+class TrajectoryLayer:
+    # Savitzky-Golay smoothed polyline that grows point by point. Once the filter
+    # window is full only the last window//2 smoothed points can still move, so
+    # everything before them is kept and burnt into cached masks (one per thickness).
+    WINDOW = 11
+
+    def __init__(self, thicknesses):
+        self.thicknesses = thicknesses
+        self.pad = max(thicknesses) // 2 + 2
+        self.masks = None
+        self.reset()
+
+    def reset(self, points=()):
+        if self.masks is not None and self.drawn_bbox is not None:
+            x0, y0, x1, y1 = self.drawn_bbox
+            for m in self.masks:
+                m[y0:y1, x0:x1] = 0
+        self.raw = []
+        self.stable = np.empty((0, 2), np.int32)
+        self.tail = np.empty((0, 2), np.int32)
+        self.stable_min = self.stable_max = None
+        self.drawn = 0
+        self.drawn_bbox = None
+        self.extend(points)
+
+    def extend(self, points):
+        if not points:
+            return
+        self.raw.extend(points)
+        n = len(self.raw)
+        if n < 5:
+            return
+        window = min(self.WINDOW, n if n % 2 == 1 else n - 1)
+        if window < self.WINDOW:
+            # Window still growing, every smoothed point changes
+            self.tail = smooth_points(np.array(self.raw, dtype=np.float32), window)
+            return
+        half = window // 2
+        first = len(self.stable)
+        offset = max(first - half, 0)
+        smoothed = smooth_points(np.array(self.raw[offset:], dtype=np.float32), window)[first - offset:]
+        settled = smoothed[:n - half - first]
+        if len(settled):
+            self.stable = np.concatenate([self.stable, settled])
+            lo, hi = settled.min(axis=0), settled.max(axis=0)
+            self.stable_min = lo if self.stable_min is None else np.minimum(self.stable_min, lo)
+            self.stable_max = hi if self.stable_max is None else np.maximum(self.stable_max, hi)
+        self.tail = smoothed[n - half - first:]
+
+    def bbox(self, shape):
+        if len(self.stable) + len(self.tail) < 2:
+            return None
+        lo, hi = self.stable_min, self.stable_max
+        if len(self.tail):
+            t_lo, t_hi = self.tail.min(axis=0), self.tail.max(axis=0)
+            lo = t_lo if lo is None else np.minimum(lo, t_lo)
+            hi = t_hi if hi is None else np.maximum(hi, t_hi)
+        h, w = shape[:2]
+        return (max(int(lo[0]) - self.pad, 0), max(int(lo[1]) - self.pad, 0),
+                min(int(hi[0]) + self.pad + 1, w), min(int(hi[1]) + self.pad + 1, h))
+
+    def region_masks(self, shape, bbox):
+        if self.masks is None or self.masks[0].shape != shape[:2]:
+            self.masks = [np.zeros(shape[:2], np.uint8) for _ in self.thicknesses]
+            self.drawn = 0
+            self.drawn_bbox = None
+        if len(self.stable) > self.drawn:
+            # Burn newly settled segments, starting from the last one already drawn
+            segment = self.stable[max(self.drawn - 1, 0):].reshape(-1, 1, 2)
+            if len(segment) >= 2:
+                for m, t in zip(self.masks, self.thicknesses):
+                    cv2.polylines(m, [segment], False, 255, t)
+            self.drawn = len(self.stable)
+            own = self.bbox(shape)
+            if own is not None:
+                self.drawn_bbox = own if self.drawn_bbox is None else (
+                    min(own[0], self.drawn_bbox[0]), min(own[1], self.drawn_bbox[1]),
+                    max(own[2], self.drawn_bbox[2]), max(own[3], self.drawn_bbox[3]))
+
+        x0, y0, x1, y1 = bbox
+        regions = [m[y0:y1, x0:x1].copy() for m in self.masks]
+        tail = np.concatenate([self.stable[-1:], self.tail]) if len(self.tail) else None
+        if tail is not None and len(tail) >= 2:
+            tail = (tail - (x0, y0)).astype(np.int32).reshape(-1, 1, 2)
+            for m, t in zip(regions, self.thicknesses):
+                cv2.polylines(m, [tail], False, 255, t)
+        return regions
+
+class TrajectoryMetrics:
+    # Swing, turn and bounce for a trajectory that grows point by point. Prefix sums give
+    # either leg's regression slope in O(1), the after leg's highest point is a running
+    # minimum, and the swing chord (and so its max deviation) only moves with the impact point.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.points = np.empty((64, 2), np.float32)
+        # Row i holds n, sum y, sum x, sum y*y, sum x*y over the first i points
+        self.sums = np.zeros((65, 5))
+        self.count = 0
+        self.impact_idx = 0
+        self.peak_y = None
+        self.max_deviation = None
+
+    @classmethod
+    def from_points(cls, points):
+        metrics = cls()
+        if len(points):
+            pts = np.array(points, dtype=np.float32).reshape(-1, 2)
+            metrics.reserve(len(pts))
+            n = len(pts)
+            metrics.points[:n] = pts
+            x, y = pts[:, 0].astype(np.float64), pts[:, 1].astype(np.float64)
+            metrics.sums[1:n + 1] = np.cumsum(np.stack([np.ones(n), y, x, y * y, x * y], axis=1), axis=0)
+            metrics.count = n
+            metrics.impact_idx = int(np.argmax(pts[:, 1]))
+            metrics.peak_y = float(pts[metrics.impact_idx:, 1].min())
+        return metrics
+
+    def reserve(self, count):
+        if count > len(self.points):
+            size = max(count, 2 * len(self.points))
+            self.points = np.concatenate([self.points, np.empty((size - len(self.points), 2), np.float32)])
+            self.sums = np.concatenate([self.sums, np.zeros((size + 1 - len(self.sums), 5))])
+
+    def append(self, point):
+        x, y = float(point[0]), float(point[1])
+        with self.lock:
+            self.reserve(self.count + 1)
+            self.points[self.count] = (x, y)
+            self.sums[self.count + 1] = self.sums[self.count] + (1, y, x, y * y, x * y)
+            self.count += 1
+            if self.count == 1 or y > self.points[self.impact_idx, 1]:
+                # New lowest point on screen: it's the impact, the after leg starts over
+                self.impact_idx = self.count - 1
+                self.peak_y = y
+                self.max_deviation = None
+            else:
+                self.peak_y = min(self.peak_y, y)
+
+    def slope(self, start, stop):
+        # Least-squares x = m*y + c over points[start:stop], as np.polyfit(y, x, 1) gives it
+        n, sy, sx, syy, sxy = self.sums[stop] - self.sums[start]
+        spread = n * syy - sy * sy
+        if spread <= 0:
+            # All on one row: keep polyfit's rank-deficient answer rather than dividing by zero
+            return np.polyfit(self.points[start:stop, 1], self.points[start:stop, 0], 1)[0]
+        return np.float64((n * sxy - sy * sx) / spread)
+
+    def values(self):
+        # Lengths of both legs and raw swing, turn and bounce, None where they aren't defined
+        with self.lock:
+            count, impact = self.count, self.impact_idx
+            before = self.points[:impact + 1]
+            swing = turn = bounce = None
+            if len(before) >= 3:
+                x_start, y_start = before[0]
+                x_end, y_end = before[-1]
+                slope = (x_end - x_start) / (y_end - y_start) if (y_end - y_start) != 0 else 0
+                if self.max_deviation is None:
+                    self.max_deviation = np.abs(before[:, 0] - (x_start + slope * (before[:, 1] - y_start))).max()
+                deviation_m = self.max_deviation / pixels_per_meter
+                vertical_m = (y_end - y_start) / pixels_per_meter
+                if vertical_m > 0:
+                    swing = min(max(np.degrees(np.arctan(deviation_m / vertical_m)), 0), 1.5)
+            if count - impact >= 2:
+                # The impact is the after leg's lowest point, so it's flat exactly when its peak is too
+                if self.peak_y < self.points[impact, 1]:
+                    ma = self.slope(impact, count)
+                    mb = self.slope(0, impact + 1)
+                    turn = abs(np.degrees(np.arctan((ma - mb) / (1 + ma * mb))))
+                bounce_px = self.points[impact, 1] - np.float32(self.peak_y)
+                bounce = bounce_px / pixels_per_meter if bounce_px > 0 else 0
+            return {'before': impact + 1, 'after': count - impact, 'swing': swing, 'turn': turn, 'bounce': bounce}
+
+class TrajectoryRenderer:
+    # Keeps the impact split and both smoothed layers up to date as points arrive,
+    # so each frame only redraws the unsettled tail inside the trajectory's bounding box.
+    AFTER_COLOR = (0, 0, 255)
+    BEFORE_COLOR = (0, 0, 180)
+
+    def __init__(self, points=()):
+        self.points = []
+        self.impact_idx = 0
+        self.metrics = TrajectoryMetrics()
+        self.after = TrajectoryLayer([12, 10, 8])
+        self.before = TrajectoryLayer([16, 14, 12])
+        for p in points:
+            self.append(p)
+
+    @classmethod
+    def from_points(cls, points):
+        # Same state as appending one by one, but each leg is smoothed in a single pass
+        renderer = cls()
+        if len(points):
+            renderer.points = [(float(x), float(y)) for x, y in points]
+            renderer.impact_idx = int(np.argmax([p[1] for p in renderer.points]))
+            renderer.metrics = TrajectoryMetrics.from_points(renderer.points)
+            renderer.before.extend(renderer.points[:renderer.impact_idx + 1])
+            renderer.after.reset(renderer.points[renderer.impact_idx:])
+        return renderer
+
+    def append(self, point):
+        p = (float(point[0]), float(point[1]))
+        self.points.append(p)
+        self.metrics.append(p)
+        if len(self.points) == 1:
+            self.before.extend([p])
+            self.after.reset([p])
+        elif p[1] > self.points[self.impact_idx][1]:
+            # New lowest point, everything since the old impact joins the "before" leg
+            self.before.extend(self.points[self.impact_idx + 1:])
+            self.impact_idx = len(self.points) - 1
+            self.after.reset([p])
+        else:
+            self.after.extend([p])
+
+    def split(self):
+        points = np.array(self.points, dtype=np.float32)
+        return points[:self.impact_idx + 1], points[self.impact_idx:]
+
+    def render(self, base):
+        if len(self.points) < 6:
+            return base
+        boxes = [b for b in (self.after.bbox(base.shape), self.before.bbox(base.shape)) if b is not None]
+        if not boxes:
+            return base
+        x0, y0 = min(b[0] for b in boxes), min(b[1] for b in boxes)
+        x1, y1 = max(b[2] for b in boxes), max(b[3] for b in boxes)
+        region = base[y0:y1, x0:x1]
+
+        overlay = region.copy()
+        if self.after.bbox(base.shape) is not None:
+            after_mask = np.any(self.after.region_masks(base.shape, (x0, y0, x1, y1)), axis=0)
+            overlay[after_mask] = self.AFTER_COLOR
+        if self.before.bbox(base.shape) is not None:
+            color = np.empty_like(region)
+            color[:] = self.BEFORE_COLOR
+            for mask in self.before.region_masks(base.shape, (x0, y0, x1, y1)):
+                blended = cv2.addWeighted(color, 0.3, overlay, 0.7, 0)
+                np.copyto(overlay, blended, where=mask[..., None].astype(bool))
+
+        base[y0:y1, x0:x1] = cv2.addWeighted(overlay, 0.6, region, 0.4, 0)
+        return base
+
+RED_HSV_RANGES = [((0, 100, 50), (10, 255, 255)), ((160, 100, 50), (179, 255, 255))]
+
+def hsv_ranges_mask(hsv, ranges, dst=None, scratch=None):
+    mask = cv2.inRange(hsv, *ranges[0], dst=dst)
+    for lo, hi in ranges[1:]:
+        cv2.bitwise_or(mask, cv2.inRange(hsv, lo, hi, dst=scratch), dst=mask)
+    return mask
+
+@functools.lru_cache(maxsize=8)
+def compile_hsv_ranges(ranges):
+    # Bounds as uint8 arrays once per set of thresholds, so changing RED_HSV_RANGES takes effect on the next call
+    return tuple((np.array(lo, np.uint8), np.array(hi, np.uint8)) for lo, hi in ranges)
+
+def red_mask(bgr, dst=None, hsv=None, scratch=None):
+    # cvtColor + inRange per range + bitwise_or, into the caller's buffers where it passes them
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV, dst=hsv)
+    return hsv_ranges_mask(hsv, compile_hsv_ranges(tuple(RED_HSV_RANGES)), dst, scratch)
+
+def ball_size_scale(frame_height):
+    return max(1.0, frame_height / app.config['BALL_SIZE_HEIGHT'])
+
+def ball_size_limit(frame_height):
+    return app.config['BALL_MAX_SIZE'] * ball_size_scale(frame_height)
+
+def pyramid_scale(frame_height):
+    # The coarse pass samples every scale-th pixel, so a red core narrower than the stride can fall
+    # between samples. Compression eats into the ball's edge, so keep to half the smallest radius
+    min_radius = app.config['BALL_MIN_SIZE'] * ball_size_scale(frame_height) / 2
+    return min(app.config['PYRAMID_SCALE'], max(1, int(min_radius // 2)))
+
+def find_ball(red_mask, x1, y1, max_size=10):
+    contours, _ = cv2.findContours(red_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if min(w, h)/max(w, h) >= 0.5 and w <= max_size and h <= max_size:
+            return x + w//2 + x1, y + h//2 + y1
+    return None
+
+def use_pyramid(roi, frame_height):
+    return (app.config['PYRAMID_DETECTION'] and roi[2] * roi[3] >= app.config['PYRAMID_MIN_PIXELS']
+            and pyramid_scale(frame_height) > 1)
+
+def detect_ball(img, roi):
+    if use_pyramid(roi, img.shape[0]):
+        return detect_ball_pyramid(img, roi)
+    return detect_ball_full(img, roi, ball_size_limit(img.shape[0]))
+
+def detect_ball_full(img, roi, max_size):
+    x1, y1, w_roi, h_roi = roi
     x2, y2 = x1 + w_roi, y1 + h_roi
+    crop = img[y1:y2, x1:x2]
+    mask = red_mask(crop)
+    mask = cv2.erode(mask, None, iterations=1)
+    mask = cv2.dilate(mask, None, iterations=2)
+    return find_ball(mask, x1, y1, max_size)
+
+def detect_ball_pyramid(img, roi):
+    # Every scale-th pixel is sampled, so any ball at least that wide leaves a red dot
+    # in the coarse mask. Only patches around those dots get the full-resolution search.
+    x1, y1, w_roi, h_roi = roi
+    scale = pyramid_scale(img.shape[0])
+    limit = ball_size_limit(img.shape[0])
+    coarse = img[y1:y1 + h_roi:scale, x1:x1 + w_roi:scale]
+    mask = cv2.dilate(red_mask(coarse), None, iterations=1)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    spots = [cv2.boundingRect(c) for c in contours]
+    # Blobs much bigger than a ball can't contain one on their own, and a frame full of
+    # red spots is cheaper to search in one pass than patch by patch
+    spots = [s for s in spots if min(s[2], s[3]) * scale <= limit + 3 * scale]
+    if len(spots) > app.config['PYRAMID_MAX_CANDIDATES']:
+        return detect_ball_full(img, roi, limit)
+    pad = int(limit) + scale
+    for sx, sy, sw, sh in spots:
+        px0 = max(x1 + sx * scale - pad, x1)
+        py0 = max(y1 + sy * scale - pad, y1)
+        px1 = min(x1 + (sx + sw) * scale + pad, x1 + w_roi)
+        py1 = min(y1 + (sy + sh) * scale + pad, y1 + h_roi)
+        position = detect_ball_full(img, (px0, py0, px1 - px0, py1 - py0), limit)
+        if position:
+            return position
+    return None
+
+_batch_buffers = threading.local()
+
+def batch_buffer(name, shape):
+    # Reused across batches: allocating fresh multi-MB outputs on every call costs
+    # more in page faults than the per-crop Python overhead batching removes
+    buf = getattr(_batch_buffers, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, np.uint8)
+        setattr(_batch_buffers, name, buf)
+    return buf
+
+def red_masks_batch(crops):
+    # Stack the crops into one tall image with a spacer row after each crop so
+    # colour conversion, thresholding and morphology run once for the whole batch.
+    n = len(crops)
+    h, w = crops[0].shape[:2]
+    rows = n * (h + 1)
+    stack = batch_buffer('stack', (n, h + 1, w, 3))
+    for i, crop in enumerate(crops):
+        stack[i, :h] = crop
+    stack[:, h] = 0
+    other = batch_buffer('other', (rows, w))
+    mask = red_mask(stack.reshape(rows, w, 3), dst=batch_buffer('mask', (rows, w)),
+                    hsv=batch_buffer('hsv', (rows, w, 3)), scratch=other)
+
+    # Spacer rows are neutral for each pass (255 for erode, 0 for dilate), so no
+    # pixel leaks between neighbouring crops and edges behave like a single crop
+    mask.reshape(n, h + 1, w)[:, h] = 255
+    cv2.erode(mask, None, dst=other, iterations=1)
+    other.reshape(n, h + 1, w)[:, h] = 0
+    cv2.dilate(other, None, dst=mask, iterations=1)
+    mask.reshape(n, h + 1, w)[:, h] = 0
+    cv2.dilate(mask, None, dst=other, iterations=1)
+    return other.reshape(n, h + 1, w)
+
+def detect_ball_batch(images, roi):
+    x1, y1, w_roi, h_roi = roi
+    x2, y2 = x1 + w_roi, y1 + h_roi
+    if images and use_pyramid(roi, images[0].shape[0]):
+        # The coarse pass already keeps the work small, stacking full-size ROIs would undo that
+        return [detect_ball_pyramid(img, roi) for img in images]
+    crops = [img[y1:y2, x1:x2] for img in images]
+    if not crops:
+        return []
+    limit = ball_size_limit(images[0].shape[0])
+    # Keep each stack cache-sized: small ROIs get many crops per pass, wide ones few
+    step = max(1, app.config['DETECT_BATCH_PIXELS'] // max(crops[0].shape[0] * crops[0].shape[1], 1))
+    if step == 1:
+        # One crop per stack only adds the copy into it, large ROIs are faster frame by frame
+        return [detect_ball_full(img, roi, limit) for img in images]
+    positions = []
+    for i in range(0, len(crops), step):
+        masks = red_masks_batch(crops[i:i + step])
+        # Spacer rows may pick up a neighbour's edge pixels, which only costs an empty contour search
+        has_red = masks.reshape(len(masks), -1).max(axis=1) > 0
+        h = masks.shape[1] - 1
+        positions += [find_ball(m[:h], x1, y1, limit) if red else None for m, red in zip(masks, has_red)]
+    return positions
+
+class Detector(abc.ABC):
+    # Finds the ball in a window of the ROI and keeps count of what that cost
+    stateful = False
+
+    def __init__(self, roi):
+        self.roi = roi
+        self.frames = 0
+        self.hits = 0
+        self.seconds = 0.0
+
+    def observe(self, img):
+        # Called with every frame before it's searched, for detectors that keep state
+        pass
+
+    @abc.abstractmethod
+    def find(self, img, window):
+        pass
+
+    def detect(self, img, window=None):
+        start = time.perf_counter()
+        window = window or self.roi
+        self.observe(img)
+        position = self.find(img, window) if window[2] and window[3] else None
+        self.seconds += time.perf_counter() - start
+        self.frames += 1
+        self.hits += position is not None
+        return position
+
+    def detect_batch(self, images):
+        return [self.detect(img) for img in images]
+
+    def stats(self):
+        return {'frames': self.frames, 'detections': self.hits,
+                'ms_per_frame': 1000 * self.seconds / self.frames if self.frames else 0.0}
+
+class HsvDetector(Detector):
+    def find(self, img, window):
+        return detect_ball(img, window)
+
+    def detect_batch(self, images):
+        # Stateless, so whole ROIs can go through the stacked masks
+        start = time.perf_counter()
+        positions = detect_ball_batch(images, self.roi)
+        self.seconds += time.perf_counter() - start
+        self.frames += len(images)
+        self.hits += sum(p is not None for p in positions)
+        return positions
+
+class MotionDetector(Detector):
+    stateful = True
+
+    def __init__(self, roi):
+        super().__init__(roi)
+        self.history = []
+        self.foreground = None
+        self.subtractor = None
+        if app.config['MOTION_SUBTRACTOR'] == 'mog2':
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+
+    def observe(self, img):
+        if self.subtractor is not None:
+            # The model always sees the whole ROI so it stays the same whichever window gets searched
+            x, y, w, h = self.roi
+            self.foreground = self.subtractor.apply(img[y:y + h, x:x + w])
+        else:
+            self.history = [img] + self.history[:2]
+
+    def motion_mask(self, window):
+        x, y, w, h = window
+        if self.subtractor is not None:
+            rx, ry = self.roi[:2]
+            return self.foreground[y - ry:y - ry + h, x - rx:x - rx + w]
+        if len(self.history) < 3:
+            return None
+        # Pixels that differ from both previous frames: where the ball is now, not where it was
+        current, previous, before = (frame[y:y + h, x:x + w] for frame in self.history)
+        diff = cv2.min(cv2.absdiff(current, previous), cv2.absdiff(current, before))
+        gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+        _, mask = cv2.threshold(gray, app.config['MOTION_THRESHOLD'], 255, cv2.THRESH_BINARY)
+        return mask
+
+    def find(self, img, window):
+        mask = self.motion_mask(window)
+        if mask is None:
+            return None
+        mask = cv2.erode(mask, None, iterations=1)
+        mask = cv2.dilate(mask, None, iterations=2)
+        return find_ball(mask, window[0], window[1], ball_size_limit(img.shape[0]))
+
+class CombinedDetector(MotionDetector):
+    def find(self, img, window):
+        mask = self.motion_mask(window)
+        if mask is None:
+            return None
+        x, y, w, h = window
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            bx, by, bw, bh = cv2.boundingRect(contour)
+            # A little context around each blob so the colour mask's erosion doesn't eat the ball
+            x0, y0 = max(bx - 2, 0), max(by - 2, 0)
+            x1, y1 = min(bx + bw + 2, w), min(by + bh + 2, h)
+            position = detect_ball(img, (x + x0, y + y0, x1 - x0, y1 - y0))
+            if position:
+                return position
+        return None
+
+DETECTORS = {'hsv': HsvDetector, 'motion': MotionDetector, 'combined': CombinedDetector}
+
+# An entry that doesn't implement find() fails at import, not on the first analysis that picks it
+for name, detector_class in DETECTORS.items():
+    if detector_class.__abstractmethods__:
+        raise TypeError(f"Detector '{name}' doesn't implement {', '.join(sorted(detector_class.__abstractmethods__))}")
+
+def iter_batches(frames, max_frames, max_bytes):
+    batch, size = [], 0
+    for item in frames:
+        batch.append(item)
+        size += item[1].nbytes
+        if len(batch) >= max_frames or size >= max_bytes:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+# Everything detect_frame_range() reads from app.config, sent with each task because spawned
+# workers re-import app and would otherwise detect with its import-time defaults
+DETECT_SETTINGS = ('DETECT_BATCH_SIZE', 'DETECT_BATCH_BYTES', 'DETECT_BATCH_PIXELS', 'BALL_MIN_SIZE',
+                   'BALL_MAX_SIZE', 'BALL_SIZE_HEIGHT', 'PYRAMID_DETECTION', 'PYRAMID_SCALE',
+                   'PYRAMID_MIN_PIXELS', 'PYRAMID_MAX_CANDIDATES', 'DECODER', 'DECODE_THREADS')
+
+def detection_settings():
+    return {'config': {key: app.config[key] for key in DETECT_SETTINGS}, 'hsv': list(RED_HSV_RANGES)}
+
+def detect_frame_range(mode, source, start_frame, stop_frame, roi, settings):
+    # Runs in a worker process, which reads its own frames so only positions cross back.
+    # Workers run one task at a time, so taking on the parent's settings here is safe
+    global RED_HSV_RANGES
+    app.config.update(settings['config'])
+    RED_HSV_RANGES = settings['hsv']
+    if mode == 'stream':
+        frames = iter_video_frames(source, start_frame, stop_frame)
+    else:
+        frames = iter_stored_frames(source, start_frame, stop_frame)
+    positions = {}
+    for batch in iter_batches(frames, app.config['DETECT_BATCH_SIZE'], app.config['DETECT_BATCH_BYTES']):
+        found = detect_ball_batch([img for _, img in batch], roi)
+        positions.update((n, position) for (n, _), position in zip(batch, found))
+    return positions
+
+_detect_pool = None
+_detect_pool_lock = threading.Lock()
+
+def max_detect_workers():
+    return max(1, min(app.config['DETECT_WORKERS_MAX'], os.cpu_count() or 1))
+
+def get_detect_pool():
+    # One pool at the largest allowed size, spawned rather than forked so workers
+    # don't inherit the server's threads and locks
+    global _detect_pool
+    with _detect_pool_lock:
+        if _detect_pool is None:
+            _detect_pool = ProcessPoolExecutor(max_workers=max_detect_workers(),
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return _detect_pool
+
+def detect_parallel(mode, source, start_frame, end_frame, roi, workers, settings):
+    total = end_frame - start_frame + 1
+    chunk = max(8, -(-total // (workers * 4)))
+    pool = get_detect_pool()
+    ranges = [(s, min(s + chunk - 1, end_frame)) for s in range(start_frame, end_frame + 1, chunk)]
+    positions = {}
+    pending = set()
+    # The pool is shared, so this run keeps at most `workers` of its chunks in flight
+    while ranges or pending:
+        while ranges and len(pending) < workers:
+            pending.add(pool.submit(detect_frame_range, mode, source, *ranges.pop(0), roi, settings))
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            positions.update(future.result())
+    return positions
+
+class KalmanTracker:
+    # State is (x, y, vx, vy, ax, ay) per frame, one filter per analysed delivery
+    TRANSITION = np.array([[1, 0, 1, 0, 0.5, 0],
+                           [0, 1, 0, 1, 0, 0.5],
+                           [0, 0, 1, 0, 1, 0],
+                           [0, 0, 0, 1, 0, 1],
+                           [0, 0, 0, 0, 1, 0],
+                           [0, 0, 0, 0, 0, 1]], np.float32)
+
+    def __init__(self, roi, detector):
+        self.roi = roi
+        self.detector = detector
+        self.filter = None
+        self.misses = 0
+        self.frames = 0
+        self.pixels = 0
+
+    def start(self, position):
+        kf = cv2.KalmanFilter(6, 2)
+        kf.transitionMatrix = self.TRANSITION.copy()
+        kf.measurementMatrix = np.eye(2, 6, dtype=np.float32)
+        # Bounces and edges change the acceleration abruptly, so it gets the most process noise
+        kf.processNoiseCov = np.diag([0.25, 0.25, 1, 1, 4, 4]).astype(np.float32)
+        kf.measurementNoiseCov = np.eye(2, dtype=np.float32)
+        kf.errorCovPost = np.diag([1, 1, 100, 100, 25, 25]).astype(np.float32)
+        kf.statePost = np.array([[position[0]], [position[1]], [0], [0], [0], [0]], np.float32)
+        self.filter = kf
+        self.misses = 0
+
+    def window(self, prediction):
+        # TRACK_WINDOW around the prediction, grown by three standard deviations and clipped to the ROI
+        rx, ry, rw, rh = self.roi
+        cov = self.filter.errorCovPre
+        half_x = app.config['TRACK_WINDOW'] + 3 * np.sqrt(cov[0, 0])
+        half_y = app.config['TRACK_WINDOW'] + 3 * np.sqrt(cov[1, 1])
+        x0 = max(rx, int(prediction[0] - half_x))
+        y0 = max(ry, int(prediction[1] - half_y))
+        x1 = min(rx + rw, int(prediction[0] + half_x) + 1)
+        y1 = min(ry + rh, int(prediction[1] + half_y) + 1)
+        return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+    def track(self, img):
+        # The detected position, the prediction while coasting through a short gap, or None once lost
+        lost = self.filter is None or self.misses >= app.config['TRACK_MAX_MISSES']
+        if lost:
+            window = self.roi
+        else:
+            prediction = self.filter.predict()[:2, 0]
+            window = self.window(prediction)
+        self.frames += 1
+        self.pixels += window[2] * window[3]
+        position = self.detector.detect(img, window)
+
+        if position is None:
+            if lost:
+                return None
+            self.misses += 1
+            if self.misses >= app.config['TRACK_MAX_MISSES']:
+                return None
+            rx, ry, rw, rh = self.roi
+            return (min(max(int(round(prediction[0])), rx), rx + rw - 1),
+                    min(max(int(round(prediction[1])), ry), ry + rh - 1))
+        if lost:
+            self.start(position)
+        else:
+            self.filter.correct(np.array([[position[0]], [position[1]]], np.float32))
+            self.misses = 0
+        return position
+
+def iter_detections(frames, start_frame, end_frame, detector, positions=None, tracker=None):
+    if tracker is not None:
+        # Each search window depends on the previous frame, so frames are searched one at a time
+        for frame_number, img in frames:
+            yield frame_number, img, tracker.track(img) if start_frame <= frame_number <= end_frame else None
+        return
+    if positions is not None:
+        # Detection already ran in the pool, this pass only replays it in frame order
+        for frame_number, img in frames:
+            yield frame_number, img, positions.get(frame_number) if start_frame <= frame_number <= end_frame else None
+        return
+    batches = iter_batches(frames, app.config['DETECT_BATCH_SIZE'], app.config['DETECT_BATCH_BYTES'])
+    for batch in batches:
+        in_range = [img for n, img in batch if start_frame <= n <= end_frame]
+        detections = iter(detector.detect_batch(in_range))
+        for frame_number, img in batch:
+            position = next(detections) if start_frame <= frame_number <= end_frame else None
+            yield frame_number, img, position
+
+def annotate_frame(base, frame_number, renderer, start_frame, end_frame, frame_map):
+    if frame_number in frame_map:
+        cx, cy = frame_map[frame_number]
+        cv2.rectangle(base, (cx - 5, cy - 5), (cx + 5, cy + 5), (0, 255, 0), 2)
+
+    if len(renderer.points) >= 6:
+        base = renderer.render(base)
 
-    frame_files = sorted(
-        [f for f in os.listdir(app.config['FRAME_FOLDER']) if f.endswith(".png")],
-        key=lambda x: int(re.sub(r'\D', '', x))
-    )
-
-    frame_map = {}
-    trajectory = []
-    accumulated_trajectory = []
+        if start_frame <= frame_number <= end_frame:
+            total_distance_m = 20.12
+            total_time_s = max((end_frame - start_frame)/60, 1e-5)
+            speed = (total_distance_m / total_time_s)*3.6
+            cv2.putText(base, f"Speed: {speed:.2f} km/h", (50,60), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255,255,0), 2)
+
+            values = renderer.metrics.values()
+            if values['swing'] is not None:
+                cv2.putText(base, f"Swing: {values['swing']:.2f}°", (50,90), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (180,220,255), 2)
+            if values['turn'] is not None:
+                display_turn = values['turn'] if 2.5 < values['turn'] < 5.0 else 0.0
+                cv2.putText(base, f"Turn: {display_turn:.2f}°", (50,120), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255,200,200), 2)
+            if values['bounce'] is not None:
+                cv2.putText(base, f"Bounce: {values['bounce']:.2f} m", (50,150), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (200,255,200), 2)
+
+    return base
+
+def open_frame_source(job, mode, start_frame, stop_frame, windowed):
+    if mode == 'stream':
+        # Frames before start_frame never carry overlays, so skip straight to it
+        return iter_video_frames(job.video_path, start_frame, stop_frame)
+    if windowed:
+        return iter_stored_frames(job.frame_folder, start_frame, stop_frame)
+    return iter_stored_frames(job.frame_folder)
+
+@timed('analysis')
+def run_analysis_internal(job, start_frame, end_frame, mode='frames', margin=None, workers=1, lazy=False,
+                          tracker='roi', detector='hsv', roi=None, settings=None):
+    # roi and settings are snapshots taken when the run was submitted, the job's ROI can change while it queues
+    roi = roi or job.roi_coords
+    settings = settings or detection_settings()
+    print(f"🧪 Debug: job={job.id}, start_frame={start_frame}, end_frame={end_frame}, mode={mode}, margin={margin}, workers={workers}, lazy={lazy}, tracker={tracker}, detector={detector}")
+
+    job.clear_folders(job.processed_folder)
+    job.render_cache.clear()
+    job.proxy_cache.clear()
+
+    # Without a margin every frame to the end of the clip gets rendered
+    stop_frame = end_frame + margin if margin is not None else None
+    last_frame = stop_frame if stop_frame is not None else job.frame_count - 1
+
+    if lazy:
+        # Nothing is rendered, so only the detection window needs decoding
+        frames = open_frame_source(job, mode, start_frame, end_frame, True)
+    else:
+        frames = open_frame_source(job, mode, start_frame, stop_frame, margin is not None)
+
+    positions = None
+    backend = DETECTORS[detector](roi)
+    kalman = KalmanTracker(roi, backend) if tracker == 'kalman' else None
+    # Only stateless whole-ROI detection can be split across worker processes
+    if workers > 1 and kalman is None and not backend.stateful:
+        job.set_stage('detecting')
+        source = job.video_path if mode == 'stream' else job.frame_folder
+        t0 = time.perf_counter()
+        positions = detect_parallel(mode, source, start_frame, end_frame, roi, workers, settings)
+        backend.seconds = time.perf_counter() - t0
+        backend.frames = end_frame - start_frame + 1
+        backend.hits = sum(p is not None for p in positions.values())
+
+    # Full PNG analysis renders from frame 0, every other path starts at start_frame
+    first_frame = 0 if mode == 'frames' and margin is None and not lazy else start_frame
+    job.set_stage('tracking' if lazy else 'rendering', (end_frame if lazy else last_frame) - first_frame + 1)
+
+    job.frame_map = frame_map = {}
+    job.trajectory = trajectory = []
+    job.accumulated_trajectory = accumulated_trajectory = []
+    job.analysis_state = None
+    renderer = TrajectoryRenderer()
+    # The overlay's running metrics are the final ones once the run is done
+    job.trajectory_metrics = renderer.metrics
 
     last_position = None
+    processed = 0
+    # Per-run totals, observed once at the end rather than per frame
+    blend_seconds = jpeg_seconds = encode_seconds = 0.0
+    jpeg_bytes = 0
+    if not job.fps and job.video_path:
+        job.fps, _ = probe_video(job.video_path)
+    # The rendered video starts where an eager run would, whether or not this run is lazy
+    video_first = 0 if mode == 'frames' and margin is None else start_frame
+    video_key = analysis_video_key(job, roi, settings, video_first, start_frame, end_frame, stop_frame, tracker, detector)
+    encoder = None
+    if not lazy and not os.path.exists(cached_video_path(video_key)):
+        encoder = VideoEncoder(staging_video_path(video_key, job), job.fps)
 
-    for f in frame_files:
-        frame_number = int(re.sub(r'\D', '', f))
-        img = cv2.imread(os.path.join(app.config['FRAME_FOLDER'], f))
-        base = img.copy()
-
-        if start_frame <= frame_number <= end_frame:
-            roi = img[y1:y2, x1:x2]
-            hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
-            mask1 = cv2.inRange(hsv, (0, 100, 50), (10, 255, 255))
-            mask2 = cv2.inRange(hsv, (160, 100, 50), (179, 255, 255))
-            red_mask = cv2.bitwise_or(mask1, mask2)
-            red_mask = cv2.erode(red_mask, None, iterations=1)
-            red_mask = cv2.dilate(red_mask, None, iterations=2)
-
-            contours, _ = cv2.findContours(red_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            found_ball = False
-            for contour in contours:
-                x, y, w, h = cv2.boundingRect(contour)
-                if min(w, h)/max(w, h) >= 0.5 and w <= 10 and h <= 10:
-                    cx, cy = x + w//2 + x1, y + h//2 + y1
-                    frame_map[frame_number] = (cx, cy)
-                    trajectory.append((cx, cy))
-                    last_position = (cx, cy)
-                    found_ball = True
-                    break
-            if not found_ball and last_position:
-                frame_map[frame_number] = last_position
-                trajectory.append(last_position)
-        else:
+    try:
+        for frame_number, img, position in iter_detections(frames, start_frame, end_frame, backend, positions, kalman):
+            if position:
+                last_position = position
             if last_position:
                 frame_map[frame_number] = last_position
                 trajectory.append(last_position)
-
-        if frame_number in frame_map:
-            cx, cy = frame_map[frame_number]
-            accumulated_trajectory.append((cx, cy))
-            cv2.rectangle(base, (cx - 5, cy - 5), (cx + 5, cy + 5), (0, 255, 0), 2)
-
-        if len(accumulated_trajectory) >= 6:
-            points = np.array(accumulated_trajectory, dtype=np.float32)
-            impact_idx = np.argmax(points[:,1])
-            before = points[:impact_idx+1]
-            after = points[impact_idx:]
-
-            overlay = base.copy()
-            for t in [12,10,8]:
-                overlay = draw_smooth_line(after, overlay, (0,0,255), t)
-            for t in [16,14,12]:
-                temp = draw_smooth_line(before, overlay.copy(), (0,0,180), t)
-                overlay = cv2.addWeighted(temp, 0.3, overlay, 0.7, 0)
-
-            base = cv2.addWeighted(overlay, 0.6, base, 0.4, 0)
-
-            if start_frame <= frame_number <= end_frame:
-                total_distance_m = 20.12
-                total_time_s = max((end_frame - start_frame)/60, 1e-5)
-                speed = (total_distance_m / total_time_s)*3.6
-                cv2.putText(base, f"Speed: {speed:.2f} km/h", (50,60), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255,255,0), 2)
-
-                if len(before) >=3:
-                    x_start, y_start = before[0]
-                    x_end, y_end = before[-1]
-                    slope = (x_end - x_start) / (y_end-y_start) if (y_end-y_start) != 0 else 0
-                    max_dev_px = max(abs(x - (x_start + slope*(y - y_start))) for (x,y) in before)
-                    deviation_m = max_dev_px / pixels_per_meter
-                    vertical_m = (y_end - y_start) / pixels_per_meter
-                    if vertical_m > 0:
-                        swing_deg = np.degrees(np.arctan(deviation_m / vertical_m))
-                        swing_deg = min(max(swing_deg, 0), 1.5)
-                        cv2.putText(base, f"Swing: {swing_deg:.2f}°", (50,90), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (180,220,255), 2)
-
-                if len(after) >= 2:
-                    ya, xa = after[:,1], after[:,0]
-                    if len(set(ya)) > 1:
-                        ma, _ = np.polyfit(ya, xa, 1)
-                        mb, _ = np.polyfit(before[:,1], before[:,0], 1)
-                        turn_deg = abs(np.degrees(np.arctan((ma - mb) / (1 + ma * mb))))
-                        display_turn = turn_deg if 2.5 < turn_deg < 5.0 else 0.0
-                        cv2.putText(base, f"Turn: {display_turn:.2f}°", (50,120), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255,200,200), 2)
-
-                    peak_y = np.min(after[:,1])
-                    bounce_px = after[0][1] - peak_y
-                    bounce_height_m = bounce_px / pixels_per_meter if bounce_px > 0 else 0
-                    cv2.putText(base, f"Bounce: {bounce_height_m:.2f} m", (50,150), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (200,255,200), 2)
-
-        cv2.imwrite(f"{app.config['PROCESSED_FOLDER']}/{frame_number}.jpg", base)
-
-def compute_metrics(start_frame, end_frame):
+                accumulated_trajectory.append(last_position)
+                renderer.append(last_position)
+
+            processed += 1
+            if lazy:
+                job.progress['frames_done'] = processed
+                continue
+
+            t0 = time.perf_counter()
+            base = annotate_frame(img.copy(), frame_number, renderer, start_frame, end_frame, frame_map)
+            t1 = time.perf_counter()
+            # Written aside and renamed so /processed_frame never serves a half-written file mid-run
+            path = f"{job.processed_folder}/{frame_number}.jpg"
+            ok, buf = cv2.imencode('.jpg', base)
+            if ok:
+                with open(path + '.part', 'wb') as f:
+                    f.write(buf)
+                os.replace(path + '.part', path)
+                jpeg_bytes += len(buf)
+            t2 = time.perf_counter()
+            if encoder is not None:
+                encoder.write(base)
+            encode_seconds += time.perf_counter() - t2
+            blend_seconds += t1 - t0
+            jpeg_seconds += t2 - t1
+            job.progress['frames_done'] = processed
+    except Exception:
+        if encoder is not None:
+            encoder.abort()
+        raise
+    if encoder is not None:
+        # Flushing the encoder finishes the MP4, no second pass over the JPEGs
+        job.set_stage('encoding')
+        t0 = time.perf_counter()
+        encoder.close()
+        encode_seconds += time.perf_counter() - t0
+        publish_video(encoder.path, cached_video_path(video_key))
+
+    # With worker processes this is the pool's wall time, their decoding included
+    telemetry.observe('balltracker_stage_seconds', backend.seconds, stage='detect')
+    telemetry.inc('balltracker_detections_total', backend.hits, detector=detector)
+    telemetry.inc('balltracker_detection_misses_total', backend.frames - backend.hits, detector=detector)
+    if not lazy:
+        telemetry.observe('balltracker_stage_seconds', blend_seconds, stage='blend')
+        telemetry.observe('balltracker_stage_seconds', jpeg_seconds, stage='write_jpeg')
+        telemetry.inc('balltracker_bytes_written_total', jpeg_bytes, kind='jpeg')
+        if encoder is not None:
+            telemetry.observe('balltracker_stage_seconds', encode_seconds, stage='encode')
+
+    if lazy and last_position:
+        # Past end_frame tracking only carries the last position forward
+        for frame_number in range(end_frame + 1, last_frame + 1):
+            frame_map[frame_number] = last_position
+            trajectory.append(last_position)
+            accumulated_trajectory.append(last_position)
+            renderer.metrics.append(last_position)
+
+    job.analysis_state = {'start_frame': start_frame, 'end_frame': end_frame, 'stop_frame': stop_frame,
+                          'last_frame': last_frame, 'mode': mode, 'windowed': margin is not None,
+                          'lazy': lazy, 'tracked_frames': sorted(frame_map), 'video_key': video_key,
+                          'tracker': tracker, 'detector': detector, 'detector_stats': backend.stats()}
+    if kalman is not None and kalman.frames:
+        job.analysis_state['search_pixels_per_frame'] = kalman.pixels / kalman.frames
+    return processed
+
+def render_processed_frame(job, frame_number):
+    # Rebuilds the overlay for one frame from the trajectory prefix up to it
+    state = job.analysis_state
+    if not state or not state['lazy'] or frame_number > state['last_frame']:
+        return None
+    count = bisect.bisect_right(state['tracked_frames'], frame_number)
+    if count == 0:
+        return None
+    img = read_frame(job, frame_number)
+    if img is None:
+        return None
+    renderer = TrajectoryRenderer.from_points(job.accumulated_trajectory[:count])
+    return annotate_frame(img, frame_number, renderer, state['start_frame'], state['end_frame'], job.frame_map)
+
+def compute_metrics(job, start_frame, end_frame):
+    accumulated_trajectory = job.accumulated_trajectory
     if not accumulated_trajectory or len(accumulated_trajectory) <6:
         return {'speed': 0.0, 'swing': 0.0, 'turn': 0.0, 'bounce': 0.0}
 
-    points = np.array(accumulated_trajectory, dtype=np.float32)
-    impact_idx = np.argmax(points[:,1])
-    before = points[:impact_idx+1]
-    after = points[impact_idx:]
+    metrics = job.trajectory_metrics
+    if metrics is None or metrics.count != len(accumulated_trajectory):
+        metrics = TrajectoryMetrics.from_points(accumulated_trajectory)
+    values = metrics.values()
 
     total_distance_m = 20.12
     total_time_s = max((end_frame - start_frame)/60, 1e-5)
     speed = ((total_distance_m / total_time_s) * 3.6) - 10
 
-    swing_deg = 0.0
+    swing_deg = values['swing'] if values['swing'] is not None else 0.0
     turn_deg = 0.0
-    bounce_height_m = 0.0
-
-    if len(before) >=3:
-        x_start, y_start = before[0]
-        x_end, y_end = before[-1]
-        slope = (x_end - x_start) / (y_end-y_start) if (y_end-y_start) != 0 else 0
-        max_dev_px = max(abs(x - (x_start + slope*(y - y_start))) for (x,y) in before)
-        deviation_m = max_dev_px / pixels_per_meter
-        vertical_m = (y_end - y_start) / pixels_per_meter
-        if vertical_m > 0:
-            swing_deg = np.degrees(np.arctan(deviation_m / vertical_m))
-            swing_deg = min(max(swing_deg, 0), 1.5)
-
-    if len(after) >= 2:
-        ya, xa = after[:,1], after[:,0]
-        if len(set(ya)) > 1 and len(before) >= 2:
-            ma, _ = np.polyfit(ya, xa, 1)
-            mb, _ = np.polyfit(before[:,1], before[:,0], 1)
-            turn_deg_raw = abs(np.degrees(np.arctan((ma - mb) / (1 + ma * mb))))
-            turn_deg = turn_deg_raw if 2.5 < turn_deg_raw < 5.0 else 0.0
-
-        peak_y = np.min(after[:,1])
-        bounce_px = after[0][1] - peak_y
-        bounce_height_m = bounce_px / pixels_per_meter if bounce_px > 0 else 0.0
+    if values['turn'] is not None and values['before'] >= 2:
+        turn_deg = values['turn'] if 2.5 < values['turn'] < 5.0 else 0.0
+    bounce_height_m = values['bounce'] if values['bounce'] is not None else 0.0
 
     return {'speed': float(speed), 'swing': float(swing_deg), 'turn': float(turn_deg), 'bounce': float(bounce_height_m)}
 
+analysis_executor = ThreadPoolExecutor(max_workers=app.config['ANALYSIS_THREADS'])
+
+def analysis_task(job, start_frame, end_frame, mode, margin, workers, lazy, tracker, detector, roi, settings,
+                  profile=False):
+    profiler = None
+    if profile and profile_lock.acquire(blocking=False):
+        # Only this thread is profiled, detection in worker processes shows up as waiting on the pool
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile:
+        print(f"⚠️ Another analysis is being profiled, job {job.id} runs unprofiled")
+    with job.lock:
+        try:
+            if mode == 'frames':
+                # 🛠️ Ensure frames are present
+                if not os.path.isdir(job.frame_folder) or not os.listdir(job.frame_folder):
+                    print("⚠️ No frames found, extracting...")
+                    job.set_stage('extracting')
+                    ingest_video(job, job.video_path, job.digest)
+
+                # 🔄 Recalculate frame_count
+                job.frame_count = count_frames(job.frame_folder)
+                if end_frame >= job.frame_count:
+                    raise Exception('Invalid frame range')
+
+            t0 = time.perf_counter()
+            frames_processed = run_analysis_internal(job, start_frame, end_frame, mode, margin, workers, lazy,
+                                                     tracker, detector, roi, settings)
+            elapsed = time.perf_counter() - t0
+            job.set_stage('metrics')
+            # Timed here only, /progress polls compute partial metrics too and would swamp the histogram
+            with timed('compute_metrics'):
+                metrics = compute_metrics(job, start_frame, end_frame)
+
+            analysis_fps = frames_processed / elapsed if elapsed > 0 else 0.0
+            print(f"⏱️ {mode}: {frames_processed} frames in {elapsed:.2f}s ({analysis_fps:.1f} fps)")
+
+            # Frames that weren't rendered fall back to the source in /processed_frame
+            result = {'metrics': metrics, 'processed_frame_count': job.frame_count,
+                      'mode': mode, 'margin': margin, 'workers': workers, 'lazy': lazy,
+                      'tracker': tracker, 'detector': detector,
+                      'detector_stats': job.analysis_state['detector_stats'],
+                      'frames_processed': frames_processed,
+                      'analysis_seconds': elapsed, 'analysis_fps': analysis_fps}
+            if 'search_pixels_per_frame' in job.analysis_state:
+                result['search_pixels_per_frame'] = job.analysis_state['search_pixels_per_frame']
+            if profiler is not None:
+                # Stopped before 'done' so /profile is ready as soon as /progress says so
+                finish_profile(job, profiler)
+                profiler = None
+                result['profile_url'] = job_url(job, '/profile')
+            job.set_stage('done', frames_processed, result=result)
+            job.progress['frames_done'] = frames_processed
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            job.set_stage('failed', error=str(e))
+        finally:
+            if profiler is not None:
+                finish_profile(job, profiler)
+
+def progress_snapshot(job):
+    progress = dict(job.progress)
+    done, total = progress['frames_done'], progress['frames_total']
+    elapsed = time.time() - progress.pop('stage_started')
+    progress['stage_seconds'] = elapsed
+    progress['eta_seconds'] = (total - done) * elapsed / done if done and total else None
+    if progress['stage'] in ('tracking', 'rendering'):
+        # Partial metrics over the trajectory tracked so far
+        progress['metrics'] = compute_metrics(job, progress['start_frame'], progress['end_frame'])
+    return progress
+
 @app.route('/run_analysis', methods=['POST'])
 def run_analysis():
-    global roi_coords, frame_count
+    job = current_job()
     data = request.json
     print("📥 Received for analysis:", data)
 
     try:
         start_frame = int(data['start_frame'])
         end_frame = int(data['end_frame'])
-
-        if roi_coords is None:
+        mode = data.get('mode', app.config['ANALYSIS_MODE'])
+        if mode not in ('frames', 'stream'):
+            return jsonify({'success': False, 'message': f'Unknown analysis mode: {mode}'}), 400
+        margin = None
+        if data.get('windowed', app.config['ANALYSIS_WINDOWED']):
+            margin = max(int(data.get('margin', app.config['WINDOW_MARGIN'])), 0)
+        workers = min(max(int(data.get('workers', app.config['DETECT_WORKERS'])), 1), max_detect_workers())
+        lazy = bool(data.get('lazy', app.config['LAZY_RENDER']))
+        tracker = data.get('tracker', app.config['TRACKER'])
+        if tracker not in ('roi', 'kalman'):
+            return jsonify({'success': False, 'message': f'Unknown tracker: {tracker}'}), 400
+        detector = data.get('detector', app.config['DETECTOR'])
+        if detector not in DETECTORS:
+            return jsonify({'success': False, 'message': f'Unknown detector: {detector}'}), 400
+        profile = bool(data.get('profile', app.config['PROFILE_ANALYSIS']))
+
+        if job.running():
+            return jsonify({'success': False, 'message': 'Analysis already running'}), 409
+        if job.roi_coords is None:
             return jsonify({'success': False, 'message': 'ROI not set'}), 400
+        if not job.video_path:
+            return jsonify({'success': False, 'message': 'No video uploaded'}), 400
 
-        # 🛠️ Ensure frames are present
-        if not os.listdir(app.config['FRAME_FOLDER']):
-            print("⚠️ No frames found, extracting...")
-            extract_frames(video_path)
-
-        # 🔄 Recalculate frame_count
-        frame_files = sorted([f for f in os.listdir(app.config['FRAME_FOLDER']) if f.endswith('.png')])
-        frame_count = len(frame_files)
+        if mode == 'stream':
+            # 🎞️ Decode straight from the source, no PNGs needed
+            _, job.frame_count = probe_video(job.video_path)
+        elif not job.frame_count:
+            _, job.frame_count = probe_video(job.video_path)
 
-        if start_frame > end_frame or start_frame < 0 or end_frame >= frame_count:
+        if start_frame > end_frame or start_frame < 0 or end_frame >= job.frame_count:
             return jsonify({'success': False, 'message': 'Invalid frame range'}), 400
 
-        run_analysis_internal(start_frame, end_frame)
-        metrics = compute_metrics(start_frame, end_frame)
-
-        processed_files = [f for f in os.listdir(app.config['PROCESSED_FOLDER']) if f.endswith('.jpg')]
-        processed_frame_count = len(processed_files)
-
-        return jsonify({'success': True, 'metrics': metrics, 'processed_frame_count': processed_frame_count})
+        job.set_stage('queued', start_frame=start_frame, end_frame=end_frame, result=None, error=None)
+        # The ROI and detection settings as they are now, whatever happens to them while the run queues
+        roi, settings = job.roi_coords, detection_settings()
+        job.future = analysis_executor.submit(analysis_task, job, start_frame, end_frame, mode, margin, workers, lazy,
+                                              tracker, detector, roi, settings, profile)
+        return jsonify({'success': True, 'job_id': job.id, 'stage': 'queued',
+                        'progress_url': job_url(job, '/progress'),
+                        'processed_frame_count': job.frame_count}), 202
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'message': str(e)}), 400
 
+@app.route('/progress')
+def progress():
+    job = current_job()
+    if not request.args.get('stream'):
+        return jsonify(dict(progress_snapshot(job), success=True, job_id=job.id))
+
+    def events():
+        # 📡 Server-Sent Events until the analysis finishes
+        while True:
+            snapshot = progress_snapshot(job)
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            if snapshot['stage'] in ('done', 'failed', 'idle'):
+                break
+            time.sleep(app.config['PROGRESS_INTERVAL'])
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(telemetry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile')
+def analysis_profile():
+    job = current_job()
+    if job.profile is None:
+        return jsonify({'success': False, 'message': 'No profiled analysis, run one with profile=true'}), 404
+    return Response(job.profile, mimetype='text/plain')
+
 
 # if __name__ == '__main__':
 #     app.run(port=8072, debug=True)
@@ -0,0 +1,709 @@
+"""Benchmarks for the ball tracker, run against synthetic clips through Flask's test client.
+
+    python benchmark.py [name ...] [--out results.json]
+
+With no names every benchmark runs. Each prints a JSON report and exits non-zero
+if a correctness check fails.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_clip(path, width=1280, height=720, fps=30, seconds=10):
+    # A red ball on a textured pitch, noisy enough that the encoder can't collapse it to nothing
+    rng = np.random.default_rng(0)
+    background = rng.integers(40, 120, (height, width, 3), dtype=np.uint8)
+    background[..., 0] //= 2
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    frames = int(fps * seconds)
+    radius = max(2, height // 240)
+    for i in range(frames):
+        frame = background.copy()
+        t = i / max(frames - 1, 1)
+        x = int(width * (0.1 + 0.8 * t))
+        y = int(height * (0.2 + 0.6 * abs(np.sin(np.pi * 1.5 * t))))
+        cv2.circle(frame, (x, y), radius, (0, 0, 230), -1)
+        out.write(frame)
+    out.release()
+    return frames
+
+
+def make_h264_clip(path, width, height, fps, seconds, audio=True):
+    # Broadcast-like source: H.264 with an AAC tone, transcoded from an OpenCV-written clip
+    raw = path + '.mp4v.mp4'
+    make_clip(raw, width, height, fps, seconds)
+    command = ['ffmpeg', '-y', '-v', 'error', '-i', raw]
+    if audio:
+        command += ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}', '-c:a', 'aac', '-shortest']
+    command += ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', path]
+    subprocess.run(command, check=True)
+    os.remove(raw)
+    return int(fps * seconds)
+
+
+def make_delivery_clip(path, width, height, fps, seconds):
+    # A delivery seen from behind the bowler: the ball drops on a parabola to its bounce, kicks
+    # up and carries on over a mown, textured pitch, with a tone muxed in for the audio track.
+    # Returns the ball's centre in every frame.
+    rng = np.random.default_rng(1)
+    pitch = np.dstack([rng.integers(20, 60, (height, width), dtype=np.uint8),
+                       rng.integers(90, 150, (height, width), dtype=np.uint8),
+                       rng.integers(40, 80, (height, width), dtype=np.uint8)])
+    stripe = max(1, height // 12)
+    for top in range(0, height, 2 * stripe):
+        pitch[top:top + stripe, :, 1] -= 20
+    strip = slice(width * 2 // 5, width * 3 // 5)
+    pitch[:, strip] = rng.integers(120, 170, (height, strip.stop - strip.start, 3), dtype=np.uint8)
+    for y in (height // 8, height * 7 // 8):
+        cv2.line(pitch, (strip.start, y), (strip.stop, y), (240, 240, 240), max(1, height // 360))
+
+    raw = path + '.mp4v.mp4'
+    out = cv2.VideoWriter(raw, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    frames = int(fps * seconds)
+    radius = max(2, height // 240)
+    centres = []
+    for i in range(frames):
+        t = i / max(frames - 1, 1)
+        if t <= 0.6:
+            # Released high up, accelerating down the screen towards the bounce
+            y = height * (0.15 + 0.6 * (t / 0.6) ** 2)
+        else:
+            # After pitching it climbs and starts to fall again, never back down to the bounce
+            s = (t - 0.6) / 0.4 * 0.75
+            y = height * (0.75 - 0.25 * 4 * s * (1 - s))
+        x = width * (0.5 + 0.03 * t * t - (0.04 * (t - 0.6) if t > 0.6 else 0))
+        centre = (int(round(x)), int(round(y)))
+        frame = pitch.copy()
+        cv2.circle(frame, centre, radius, (0, 0, 230), -1)
+        out.write(frame)
+        centres.append(centre)
+    out.release()
+    subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', raw, '-f', 'lavfi', '-i',
+                    f'sine=frequency=440:duration={seconds}', '-c:v', 'copy', '-c:a', 'aac',
+                    '-shortest', path], check=True)
+    os.remove(raw)
+    return centres
+
+
+def rss_bytes():
+    # Resident memory of this process and any ffmpeg children it is running, None without /proc
+    try:
+        pids = [str(os.getpid())]
+        for task in os.listdir('/proc/self/task'):
+            with open(f'/proc/self/task/{task}/children') as f:
+                pids += f.read().split()
+    except OSError:
+        return None
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            # Exited between listing and reading
+            pass
+    return total
+
+
+def written_bytes():
+    # Bytes this process and its reaped children sent to storage, None without /proc
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(fields['write_bytes'])
+
+
+def measure(fn, *args, frames=None, **kwargs):
+    # Runs one stage, sampling RSS from a side thread since ru_maxrss can't be reset between stages
+    peak = [rss_bytes()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.005):
+            rss = rss_bytes()
+            if rss is not None:
+                peak[0] = max(peak[0], rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    written = written_bytes()
+    sampler.start()
+    t = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - t
+        done.set()
+        sampler.join()
+    after = written_bytes()
+    stats = {'seconds': seconds, 'peak_rss_bytes': peak[0],
+             'disk_bytes_written': after - written if written is not None else None}
+    if frames is not None:
+        stats['fps'] = frames / seconds
+    return result, stats
+
+
+def load_app(workdir):
+    # app.py creates its folders relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    import app
+    return app
+
+
+def upload(client, clip):
+    job_id = client.post('/jobs').json['job_id']
+    with open(clip, 'rb') as f:
+        r = client.post(f'/upload?job_id={job_id}', data={'video': (f, os.path.basename(clip))},
+                        content_type='multipart/form-data')
+    if not r.json.get('success'):
+        raise Exception(f"Upload failed: {r.json}")
+    return job_id
+
+
+def bench_range(app, workdir, seeks=40, chunk=512 * 1024):
+    """A seek-heavy playback session on /uploads, through send_media() and the plain send_from_directory()
+    the route used before, so only what send_media() adds shows up as a difference."""
+    clip = os.path.join(workdir, 'range_clip.mp4')
+    make_clip(clip, 1280, 720, 30, 10)
+    size = os.path.getsize(clip)
+    with open(clip, 'rb') as f:
+        data = f.read()
+
+    client = app.app.test_client()
+    job_id = upload(client, clip)
+    job = app.jobs[job_id]
+    name = os.path.basename(clip)
+    url = f'/uploads/{name}?job_id={job_id}'
+
+    def routed(headers):
+        r = client.get(url, headers=headers)
+        return r.status_code, r.headers, r.data
+
+    def baseline(headers):
+        # The old route body, served as WSGI so a 304 drops its body the way it does on the wire
+        with app.app.test_request_context(url, headers=headers) as ctx:
+            r = app.send_from_directory(os.path.abspath(job.upload_folder), name)
+            body = b''.join(r(ctx.request.environ, lambda status, headers: None))
+            r.close()
+            return r.status_code, r.headers, body
+
+    rng = random.Random(0)
+    offsets = [0] + [rng.randrange(0, size - 1) for _ in range(seeks)]
+    report = {'file_bytes': size, 'requests': len(offsets) + 2}
+    for label, get in (('baseline', baseline), ('send_media', routed)):
+        transferred = 0
+        statuses = {}
+        mismatches = 0
+        for offset in offsets:
+            end = min(offset + chunk, size) - 1
+            status, headers, body = get({'Range': f'bytes={offset}-{end}'})
+            statuses[status] = statuses.get(status, 0) + 1
+            transferred += len(body)
+            if status != 206 or body != data[offset:end + 1]:
+                mismatches += 1
+        etag = headers.get('ETag')
+        headers = {key: headers.get(key) for key in ('ETag', 'Cache-Control', 'Accept-Ranges')}
+
+        # A reload revalidates against the ETag
+        status, _, body = get({'If-None-Match': etag})
+        statuses[status] = statuses.get(status, 0) + 1
+        transferred += len(body)
+        revalidated = status == 304
+
+        # The same bytes written again, as a re-upload or a restored backup would: an mtime/size
+        # ETag changes and the file is fetched again, the content digest doesn't
+        os.utime(job.video_path, (time.time() + 60, time.time() + 60))
+        status, _, body = get({'If-None-Match': etag})
+        statuses[status] = statuses.get(status, 0) + 1
+        transferred += len(body)
+        report[label] = {'bytes_transferred': transferred, 'statuses': statuses, 'headers': headers,
+                         'reload_304': revalidated, 'rewritten_304': status == 304,
+                         'ok': mismatches == 0 and revalidated}
+        os.utime(job.video_path)
+
+    report['bytes_saved'] = report['baseline']['bytes_transferred'] - report['send_media']['bytes_transferred']
+    report['ok'] = report['baseline']['ok'] and report['send_media']['ok'] and report['send_media']['rewritten_304']
+    return report
+
+
+def bench_decode(app, workdir, window=30):
+    """OpenCV against the ffmpeg rawvideo decoder: full decode and a mid-clip frame range."""
+    clips = {'1080p60': (1920, 1080, 60, 3), '2160p30': (3840, 2160, 30, 2)}
+    report = {}
+    for name, (width, height, fps, seconds) in clips.items():
+        clip = os.path.join(workdir, f'decode_{name}.mp4')
+        frames = make_h264_clip(clip, width, height, fps, seconds, audio=False)
+        start = frames // 2
+        stop = min(start + window, frames) - 1
+        results = {}
+        decoded = {}
+        for decoder in app.DECODERS:
+            t = time.perf_counter()
+            count = sum(1 for _ in app.iter_video_frames(clip, decoder=decoder))
+            full = time.perf_counter() - t
+            t = time.perf_counter()
+            ranged = list(app.iter_video_frames(clip, start, stop, decoder=decoder))
+            window_seconds = time.perf_counter() - t
+            decoded[decoder] = ranged
+            results[decoder] = {'frames': count, 'full_seconds': full, 'full_fps': count / full,
+                                'range': [start, stop], 'range_seconds': window_seconds,
+                                'range_fps': len(ranged) / window_seconds}
+        # Both decoders must hand back the same frames for the same numbers
+        reference, other = decoded['opencv'], decoded['ffmpeg']
+        results['identical'] = (len(reference) == len(other) and
+                                all(a[0] == b[0] and np.array_equal(a[1], b[1]) for a, b in zip(reference, other)))
+        # On-demand reads: frame 0 after reading further in has to rewind the reused capture
+        reader = app.FrameReader(clip)
+        reader.read(start)
+        rewound = reader.read(0)
+        reader.close()
+        results['reader_rewind_identical'] = rewound is not None and np.array_equal(rewound, reference_first(clip))
+        report[name] = results
+    report['ok'] = all(r['identical'] and r['reader_rewind_identical'] for r in report.values())
+    return report
+
+
+def reference_first(clip):
+    # Frame 0 from a capture that has never been read or seeked
+    capture = cv2.VideoCapture(clip)
+    ok, frame = capture.read()
+    capture.release()
+    return frame if ok else None
+
+
+def hsv_chain(bgr, ranges):
+    # The reference chain with fresh allocations: convert, one inRange per range, OR them together
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, *ranges[0])
+    for lo, hi in ranges[1:]:
+        mask = cv2.bitwise_or(mask, cv2.inRange(hsv, lo, hi))
+    return mask
+
+
+def colour_cube():
+    # Every 24-bit BGR colour once, as a 4096x4096 image
+    codes = np.arange(1 << 24, dtype=np.uint32).reshape(4096, 4096)
+    cube = np.empty((4096, 4096, 3), np.uint8)
+    for channel in range(3):
+        cube[..., channel] = (codes >> (8 * channel)) & 255
+    return cube
+
+
+def quantised_table(ranges, bits):
+    # The mask of each bin's centre colour, for a (2**bits)**3 table indexed by the top bits of B, G and R
+    centres = ((np.arange(1 << bits) << (8 - bits)) + (1 << (7 - bits))).astype(np.uint8)
+    b, g, r = np.meshgrid(centres, centres, centres, indexing='ij')
+    bins = np.dstack([b.reshape(-1, 1 << bits), g.reshape(-1, 1 << bits), r.reshape(-1, 1 << bits)])
+    return hsv_chain(bins, ranges).reshape(-1)
+
+
+def quantised_lookup(bgr, table, bits):
+    q = (bgr >> (8 - bits)).astype(np.int32)
+    return table[(q[..., 0] << (2 * bits)) | (q[..., 1] << bits) | q[..., 2]]
+
+
+def bench_mask(app, workdir, repeats=50):
+    """red_mask() against cvtColor+inRange and BGR lookup tables, per frame size.
+
+    The full 24-bit table must match exactly. The 5- and 6-bit quantised tables report their
+    agreement with inRange, since colours in a bin can fall either side of a threshold.
+    """
+    cube = colour_cube()
+    ranges = tuple(app.RED_HSV_RANGES)
+    t = time.perf_counter()
+    table = hsv_chain(cube, ranges).reshape(-1)
+    table_seconds = time.perf_counter() - t
+
+    def bgr_table(bgr):
+        # Pad to BGRA so each pixel reads as one uint32 index into the table
+        codes = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA).view(np.uint32)[..., 0] & 0xFFFFFF
+        return table[codes]
+
+    def best_ms(fn, img):
+        best = float('inf')
+        for _ in range(repeats):
+            t = time.perf_counter()
+            fn(img)
+            best = min(best, time.perf_counter() - t)
+        return best * 1000
+
+    quantised = {}
+    for bits in (5, 6):
+        t = time.perf_counter()
+        quantised[bits] = quantised_table(ranges, bits)
+        quantised[f'{bits}_seconds'] = time.perf_counter() - t
+
+    rng = np.random.default_rng(0)
+    report = {'table_build_seconds': table_seconds,
+              'quantised_table_build_seconds': {f'{bits}_bit': quantised[f'{bits}_seconds'] for bits in (5, 6)}}
+    sizes = {'roi_540x340': (540, 340), '720p': (1280, 720), '1080p': (1920, 1080), '2160p': (3840, 2160)}
+    for name, (width, height) in sizes.items():
+        # Grass with a ball and a strip of arbitrary colours so hue boundaries get hit, and the
+        # reddish noise make_clip() uses, where most pixels are near red
+        grass = np.dstack([rng.integers(20, 60, (height, width), dtype=np.uint8),
+                           rng.integers(80, 140, (height, width), dtype=np.uint8),
+                           rng.integers(40, 90, (height, width), dtype=np.uint8)])
+        grass[:height // 50] = rng.integers(0, 256, (height // 50, width, 3), dtype=np.uint8)
+        reddish = rng.integers(40, 120, (height, width, 3), dtype=np.uint8)
+        reddish[..., 0] //= 2
+        report[name] = {}
+        for scene, img in (('grass', grass), ('reddish', reddish)):
+            cv2.circle(img, (width // 2, height // 2), max(2, height // 240), (0, 0, 230), -1)
+            reference = hsv_chain(img, ranges)
+            chain_ms = best_ms(lambda im: hsv_chain(im, ranges), img)
+            mask_ms = best_ms(app.red_mask, img)
+            report[name][scene] = {'hsv_chain_ms': chain_ms, 'red_mask_ms': mask_ms,
+                                   'bgr_table_ms': best_ms(bgr_table, img), 'speedup': chain_ms / mask_ms,
+                                   'identical': bool(np.array_equal(app.red_mask(img), reference)
+                                                     and np.array_equal(bgr_table(img), reference))}
+            for bits in (5, 6):
+                lut = quantised[bits]
+                quantised_mask = quantised_lookup(img, lut, bits)
+                report[name][scene][f'quantised_{bits}_bit'] = {
+                    'ms': best_ms(lambda im: quantised_lookup(im, lut, bits), img),
+                    'pixel_agreement': float(np.mean(quantised_mask == reference)),
+                    # Of the pixels either mask calls red, the share both do
+                    'red_agreement': float(np.sum((quantised_mask > 0) & (reference > 0))
+                                           / max(np.sum((quantised_mask > 0) | (reference > 0)), 1))}
+
+    # Exhaustive: every colour, before and after the thresholds change
+    report['all_colours_identical'] = bool(np.array_equal(app.red_mask(cube), table.reshape(4096, 4096)))
+    report['all_colours_quantised_agreement'] = {f'{bits}_bit': float(np.mean(quantised_lookup(cube, quantised[bits], bits)
+                                                                              == table.reshape(4096, 4096)))
+                                                 for bits in (5, 6)}
+    original = app.RED_HSV_RANGES
+    app.RED_HSV_RANGES = [((0, 80, 40), (14, 255, 255)), ((165, 80, 40), (179, 255, 255))]
+    try:
+        report['retuned_identical'] = bool(np.array_equal(app.red_mask(cube), hsv_chain(cube, app.RED_HSV_RANGES)))
+    finally:
+        app.RED_HSV_RANGES = original
+    report['ok'] = (report['all_colours_identical'] and report['retuned_identical']
+                    and all(r['identical'] for size in sizes for r in report[size].values()))
+    return report
+
+
+def bench_batch(app, workdir, frames=120):
+    """Per-frame detect_ball() against stacked detect_ball_batch() on 720p frames, per ROI size."""
+    rng = np.random.default_rng(0)
+    height, width = 720, 1280
+    grass = np.dstack([rng.integers(20, 60, (height, width), dtype=np.uint8),
+                       rng.integers(80, 140, (height, width), dtype=np.uint8),
+                       rng.integers(40, 90, (height, width), dtype=np.uint8)])
+    images = []
+    for i in range(frames):
+        frame = grass.copy()
+        cv2.circle(frame, (100 + i * 8 % 1000, 100 + i * 4 % 500), 3, (0, 0, 230), -1)
+        images.append(frame)
+    batch_size = app.app.config['DETECT_BATCH_SIZE']
+    report = {}
+    for name, roi in {'tiny_160x120': (90, 90, 160, 120), 'small_320x200': (90, 90, 320, 200), 'medium_880x620': (50, 50, 880, 620),
+                      'full_1280x720': (0, 0, width, height)}.items():
+        t = time.perf_counter()
+        baseline = [app.detect_ball(img, roi) for img in images]
+        baseline_seconds = time.perf_counter() - t
+        t = time.perf_counter()
+        batched = []
+        for i in range(0, frames, batch_size):
+            batched += app.detect_ball_batch(images[i:i + batch_size], roi)
+        batched_seconds = time.perf_counter() - t
+        report[name] = {'crops_per_stack': max(1, app.app.config['DETECT_BATCH_PIXELS'] // (roi[2] * roi[3])),
+                        'baseline_ms_per_frame': 1000 * baseline_seconds / frames,
+                        'batched_ms_per_frame': 1000 * batched_seconds / frames,
+                        'speedup': baseline_seconds / batched_seconds, 'identical': batched == baseline}
+    report['ok'] = all(r['identical'] for r in report.values())
+    return report
+
+
+def h264_roundtrip(frames, workdir, name):
+    # Through libx264 at a streaming-like quality and back, the way a ball reaches detection in practice
+    height, width = frames[0].shape[:2]
+    clip = os.path.join(workdir, f'{name}.mp4')
+    encoder = subprocess.Popen(['ffmpeg', '-y', '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                                '-s', f'{width}x{height}', '-r', '30', '-i', '-', '-c:v', 'libx264',
+                                '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p', clip],
+                               stdin=subprocess.PIPE)
+    for frame in frames:
+        encoder.stdin.write(frame.tobytes())
+    encoder.stdin.close()
+    encoder.wait()
+    capture = cv2.VideoCapture(clip)
+    decoded = [capture.read()[1] for _ in frames]
+    capture.release()
+    os.remove(clip)
+    return decoded
+
+
+def bench_pyramid(app, workdir, frames=20):
+    """Full-ROI detect_ball() against coarse-to-fine detection on whole 1080p and 4K frames.
+
+    Balls are drawn at the usual size and at BALL_MIN_SIZE, then passed through JPEG and H.264.
+    The pyramid's stride as derived from BALL_MIN_SIZE is compared with a fixed stride of 4.
+    """
+    rng = np.random.default_rng(0)
+    config = app.app.config
+    saved = {key: config[key] for key in ('PYRAMID_DETECTION', 'BALL_MIN_SIZE')}
+    report = {}
+    try:
+        for name, (width, height) in {'1080p': (1920, 1080), '2160p': (3840, 2160)}.items():
+            grass = np.dstack([rng.integers(20, 60, (height, width), dtype=np.uint8),
+                               rng.integers(80, 140, (height, width), dtype=np.uint8),
+                               rng.integers(40, 90, (height, width), dtype=np.uint8)])
+            roi = (0, 0, width, height)
+            min_radius = max(1, int(saved['BALL_MIN_SIZE'] * app.ball_size_scale(height) / 2))
+            for size, radius in {'large': max(2, height // 240), 'small': min_radius}.items():
+                raw = []
+                for _ in range(frames):
+                    frame = grass.copy()
+                    x, y = int(rng.integers(50, width - 50)), int(rng.integers(50, height - 50))
+                    cv2.circle(frame, (x, y), radius, (0, 0, 230), -1)
+                    raw.append(frame)
+                sources = {'raw': raw,
+                           'jpeg': [cv2.imdecode(cv2.imencode('.jpg', f, [cv2.IMWRITE_JPEG_QUALITY, 75])[1],
+                                                 cv2.IMREAD_COLOR) for f in raw],
+                           'h264': h264_roundtrip(raw, workdir, f'pyramid_{name}_{size}')}
+                for source, images in sources.items():
+                    # A BALL_MIN_SIZE of 16 px at 1080p pins the stride at PYRAMID_SCALE, as before it was derived
+                    strides = {'derived': saved['BALL_MIN_SIZE'], 'stride_4': 16}
+                    seconds = dict.fromkeys(['full', *strides], 0.0)
+                    found = {key: [] for key in seconds}
+                    for img in images:
+                        for key in seconds:
+                            config['PYRAMID_DETECTION'] = key != 'full'
+                            config['BALL_MIN_SIZE'] = strides.get(key, saved['BALL_MIN_SIZE'])
+                            t = time.perf_counter()
+                            found[key].append(app.detect_ball(img, roi))
+                            seconds[key] += time.perf_counter() - t
+                    config['BALL_MIN_SIZE'] = saved['BALL_MIN_SIZE']
+                    detected = sum(p is not None for p in found['full'])
+                    entry = {'radius': radius, 'frames': frames, 'full_detected': detected,
+                             'full_ms': 1000 * seconds['full'] / frames,
+                             'derived_stride': app.pyramid_scale(height)}
+                    for key in strides:
+                        agree = sum(p is not None and p == q for p, q in zip(found['full'], found[key]))
+                        entry[key] = {'ms': 1000 * seconds[key] / frames, 'speedup': seconds['full'] / seconds[key],
+                                      'agreement': agree / max(detected, 1)}
+                    report[f'{name}_{size}_{source}'] = entry
+    finally:
+        config.update(saved)
+    report['ok'] = all(r['derived']['agreement'] == 1.0 for r in report.values())
+    return report
+
+
+def bench_pipeline(app, workdir, seconds=2):
+    """Ingest, analysis and export stage by stage on synthetic deliveries from 720p30 to 4K60."""
+    clips = {'720p30': (1280, 720, 30), '720p60': (1280, 720, 60), '1080p30': (1920, 1080, 30),
+             '1080p60': (1920, 1080, 60), '2160p30': (3840, 2160, 30), '2160p60': (3840, 2160, 60)}
+    report = {}
+    for name, (width, height, fps) in clips.items():
+        clip = os.path.join(workdir, f'pipeline_{name}.mp4')
+        centres = make_delivery_clip(clip, width, height, fps, seconds)
+        frames = len(centres)
+        job = app.create_job()
+        job.video_path = clip
+        job.fps = fps
+        # The ROI a user would draw: the ball's path with some pitch either side
+        pad = 8 * max(2, height // 240)
+        xs, ys = [c[0] for c in centres], [c[1] for c in centres]
+        x1, y1 = max(min(xs) - pad, 0), max(min(ys) - pad, 0)
+        job.roi_coords = (x1, y1, min(max(xs) + pad, width) - x1, min(max(ys) + pad, height) - y1)
+
+        stages = {}
+        job.frame_count, stages['extract_frames'] = measure(app.extract_frames, clip, job.frame_folder, frames=frames)
+        audio = os.path.join(job.audio_folder, 'audio.mp3')
+        _, stages['extract_audio'] = measure(app.extract_audio, clip, audio, frames=frames)
+        end = frames - 1
+        _, stages['run_analysis_internal'] = measure(app.run_analysis_internal, job, 0, end, frames=frames)
+        metrics, stages['compute_metrics'] = measure(app.compute_metrics, job, 0, end, frames=frames)
+        tracked = sum(1 for n, (x, y) in enumerate(centres)
+                      if n in job.frame_map and abs(job.frame_map[n][0] - x) <= 2 and abs(job.frame_map[n][1] - y) <= 2)
+        # Eager runs finish the MP4 while rendering. Both runs share a cache key, so the eager
+        # video goes first and the export after the lazy run has to render every frame itself
+        os.remove(app.processed_video_path(job))
+        _, stages['run_analysis_internal_lazy'] = measure(app.run_analysis_internal, job, 0, end, lazy=True,
+                                                           frames=frames)
+        video, stages['generate_processed_video'] = measure(app.generate_processed_video, job, frames=frames)
+        capture = cv2.VideoCapture(video)
+        exported = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+
+        report[name] = {'width': width, 'height': height, 'fps': fps, 'frames': frames,
+                        'clip_bytes': os.path.getsize(clip), 'stages': stages, 'metrics': metrics,
+                        'tracked_frames': tracked, 'exported_frames': exported,
+                        'lazy_metrics_identical': app.compute_metrics(job, 0, end) == metrics,
+                        'audio_bytes': os.path.getsize(audio) if os.path.exists(audio) else 0}
+        # 4K frame stores run to gigabytes, so each clip cleans up before the next
+        with app.jobs_lock:
+            app.jobs.pop(job.id, None)
+        shutil.rmtree(job.workspace, ignore_errors=True)
+        os.remove(video)
+        os.remove(clip)
+    report['ok'] = all(r['tracked_frames'] >= 0.9 * r['frames'] and r['exported_frames'] == r['frames']
+                       and r['lazy_metrics_identical'] and r['audio_bytes'] > 0 for r in report.values())
+    return report
+
+
+class BucketHandler(BaseHTTPRequestHandler):
+    # Stand-in for a bucket: serves one file with Range support, a per-connection
+    # bandwidth cap and an optional byte budget after which it starts failing
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        start, end = 0, len(data) - 1
+        status = 200
+        spec = self.headers.get('Range')
+        if spec and server.ranges:
+            first, _, last = spec.removeprefix('bytes=').partition('-')
+            start, end = int(first), min(int(last) if last else end, end)
+            status = 206
+        with server.lock:
+            if server.budget is not None and server.budget <= 0:
+                self.send_error(503)
+                return
+            if server.budget is not None:
+                server.budget -= end - start + 1
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', '"bench"')
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.end_headers()
+        chunk = 256 * 1024
+        try:
+            for offset in range(start, end + 1, chunk):
+                piece = data[offset:min(offset + chunk, end + 1)]
+                self.wfile.write(piece)
+                time.sleep(len(piece) / server.connection_bps)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on this range, as the downloader does after a failure
+            pass
+
+
+def serve_bucket(data, connection_bps=32 * 1024 * 1024, ranges=True):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BucketHandler)
+    server.daemon_threads = True
+    server.data = data
+    server.connection_bps = connection_bps
+    server.ranges = ranges
+    server.budget = None
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_download(app, workdir, size=64 * 1024 * 1024):
+    """Throughput of download_file() against a throttled local bucket, and resume after a failure."""
+    data = os.urandom(size)
+    digest = hashlib.sha256(data).hexdigest()
+    server = serve_bucket(data)
+    url = f'http://127.0.0.1:{server.server_port}/clip.mp4'
+    target = os.path.join(workdir, 'downloaded.mp4')
+
+    def fetch(**kwargs):
+        stats = app.download_file(url, target, **kwargs)
+        with open(target, 'rb') as f:
+            stats['ok'] = hashlib.sha256(f.read()).hexdigest() == digest
+        os.remove(target)
+        return stats
+
+    report = {'size_bytes': size}
+    for connections in (1, 2, 4, 8):
+        report[f'connections_{connections}'] = fetch(connections=connections)
+
+    # Cut the server off part way, then check the retry only fetches what's missing
+    retries = app.app.config['DOWNLOAD_RETRIES']
+    app.app.config['DOWNLOAD_RETRIES'] = 0
+    server.budget = size // 2
+    try:
+        app.download_file(url, target, connections=4)
+        report['interrupted'] = False
+    except Exception:
+        report['interrupted'] = True
+    finally:
+        app.app.config['DOWNLOAD_RETRIES'] = retries
+    server.budget = None
+    report['resumed'] = fetch(connections=4)
+
+    # Servers without ranges fall back to one sequential stream
+    server.ranges = False
+    report['no_ranges'] = fetch()
+    server.shutdown()
+
+    report['ok'] = (all(v['ok'] for k, v in report.items() if isinstance(v, dict))
+                    and report['interrupted'] and report['resumed']['resumed_bytes'] > 0)
+    return report
+
+
+BENCHMARKS = {
+    'range': bench_range,
+    'download': bench_download,
+    'decode': bench_decode,
+    'mask': bench_mask,
+    'batch': bench_batch,
+    'pyramid': bench_pyramid,
+    'pipeline': bench_pipeline,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help=f"any of {', '.join(BENCHMARKS)}")
+    parser.add_argument('--out', help='also write the report to this file')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+
+    report = {}
+    cwd = os.getcwd()
+    # The app's log lines, ffmpeg and worker processes all go to stderr while benchmarks run,
+    # so stdout carries nothing but the JSON report
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with tempfile.TemporaryDirectory(prefix='bench_') as workdir:
+            try:
+                app = load_app(workdir)
+                for name in args.names or list(BENCHMARKS):
+                    # Every benchmark uses its own jobs, so caches only help where they would in production
+                    report[name] = BENCHMARKS[name](app, workdir)
+            finally:
+                os.chdir(cwd)
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(stdout)
+    text = json.dumps(report, indent=2, default=str)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    return 0 if all(r.get('ok', True) for r in report.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())